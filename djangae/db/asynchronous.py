@@ -0,0 +1,98 @@
+from google.appengine.api.datastore import IsInTransaction
+
+from django.db import connections, router
+from django.db.models import Model, signals, sql
+from django.db.models.deletion import Collector
+from django.db.models.fields import AutoField
+
+from djangae.db.backends.appengine.commands import InsertCommand, Future, wait_all
+from djangae.db.utils import has_concrete_parents
+
+
+def save_async(instance, using=None):
+    """
+        Saves a new instance, returning a Future which resolves to None once it's saved. The pre_save
+        signal is sent (and any IntegrityError raised) immediately, the primary key is set and post_save
+        is sent when the result is fetched.
+
+        Only new instances with an AutoField primary key can be inserted without waiting, anything
+        else is saved synchronously and a completed Future is returned. That includes models which
+        override save(), as the override would be skipped, and models with concrete parents.
+    """
+    model = instance.__class__
+    meta = model._meta
+    using = using or router.db_for_write(model, instance=instance)
+
+    if (instance.pk is not None or not isinstance(meta.pk, AutoField) or
+            model.save.im_func is not Model.save.im_func or
+            has_concrete_parents(model) or IsInTransaction()):
+        instance.save(using=using)
+        return Future.completed(None)
+
+    signals.pre_save.send(sender=model, instance=instance, raw=False, using=using, update_fields=None)
+
+    fields = [ x for x in meta.local_concrete_fields if not isinstance(x, AutoField) ]
+    future = InsertCommand(connections[using], model, [instance], fields, False).execute_async()
+
+    def callback():
+        key = future.get_result()[0]
+
+        setattr(instance, meta.pk.attname, key.id_or_name())
+        instance._state.db = using
+        instance._state.adding = False
+
+        signals.post_save.send(sender=model, instance=instance, created=True, update_fields=None, raw=False, using=using)
+
+    return Future(callback)
+
+
+def bulk_create_async(model, objs, using=None):
+    """
+        The asynchronous version of Model.objects.bulk_create(objs), returns a Future which
+        resolves to objs. As with bulk_create no signals are sent and primary keys aren't set.
+    """
+    if model._meta.parents:
+        raise ValueError("Can't bulk create an inherited model")
+
+    objs = list(objs)
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+
+    fields = model._meta.local_concrete_fields
+    futures = []
+
+    objs_with_pk = [ x for x in objs if x.pk is not None ]
+    if objs_with_pk:
+        futures.append(InsertCommand(connection, model, objs_with_pk, fields, False).execute_async())
+
+    objs_without_pk = [ x for x in objs if x.pk is None ]
+    if objs_without_pk:
+        fields_without_pk = [ x for x in fields if not isinstance(x, AutoField) ]
+        futures.append(InsertCommand(connection, model, objs_without_pk, fields_without_pk, False).execute_async())
+
+    def callback():
+        for future in futures:
+            future.get_result()
+        return objs
+
+    return Future(callback)
+
+
+def delete_async(queryset):
+    """
+        The asynchronous version of queryset.delete(), returns a Future which resolves to None.
+        Only querysets which Django can delete without collecting related objects or sending
+        signals are deleted asynchronously, anything else is deleted synchronously.
+    """
+    assert queryset.query.can_filter(), "Cannot use 'limit' or 'offset' with delete."
+
+    using = queryset.db
+    if not Collector(using=using).can_fast_delete(queryset):
+        queryset.delete()
+        return Future.completed(None)
+
+    query = queryset.query.clone(klass=sql.DeleteQuery)
+    query.clear_ordering(force_empty=True)
+
+    command, params = query.get_compiler(using).as_sql()
+    return command.execute_async()
@@ -2,6 +2,7 @@
 import datetime
 import decimal
 import warnings
+from collections import deque
 
 #LIBRARIES
 from django.conf import settings
@@ -43,20 +44,23 @@ from .commands import (
     FlushCommand,
     UpdateCommand,
     DeleteCommand,
-    coerce_unicode,
-    get_field_from_column
+    coerce_unicode
 )
 
 from djangae.db.backends.appengine import dbapi as Database
 
 
+# The number of queries kept in Connection.queries when DEBUG is on
+QUERIES_LOG_SIZE = 9000
+
+
 class Connection(object):
     """ Dummy connection class """
     def __init__(self, wrapper, params):
         self.creation = wrapper.creation
         self.ops = wrapper.ops
         self.params = params
-        self.queries = []
+        self.queries = deque(maxlen=QUERIES_LOG_SIZE)
 
     def rollback(self):
         pass
@@ -73,7 +77,7 @@ class Cursor(object):
     def __init__(self, connection):
         self.connection = connection
         self.start_cursor = None
-        self.returned_ids = []
+        self.last_returned_id = None
         self.rowcount = -1
         self.last_select_command = None
         self.last_delete_command = None
@@ -90,8 +94,11 @@ class Cursor(object):
         elif isinstance(sql, DeleteCommand):
             self.rowcount = sql.execute()
         elif isinstance(sql, InsertCommand):
-            self.connection.queries.append(sql)
-            self.returned_ids = sql.execute()
+            if settings.DEBUG:
+                self.connection.queries.append(sql)
+
+            returned_ids = sql.execute()
+            self.last_returned_id = returned_ids[-1] if returned_ids else None
         else:
             raise Database.CouldBeSupportedError("Can't execute traditional SQL: '%s' (although perhaps we could make GQL work)", sql)
 
@@ -101,6 +108,24 @@ class Cursor(object):
             raise StopIteration
         return row
 
+    def _entity_to_row(self, entity):
+        ## FIXME: Move this to SelectCommand.next_result()
+        result = []
+
+        # If there is extra_select prepend values to the results list
+        for col in self.last_select_command.extra_select:
+            result.append(entity.get(col))
+
+        for col, convert in self.last_select_command.column_converters:
+            if col == "__key__":
+                key = entity if isinstance(entity, Key) else entity.key()
+                self.last_returned_id = key
+                result.append(key.id_or_name())
+            else:
+                result.append(convert(entity.get(col)))
+
+        return result
+
     def fetchone(self, delete_flag=False):
         try:
             if isinstance(self.last_select_command.results, (int, long)):
@@ -114,44 +139,33 @@ class Cursor(object):
         if entity is None:
             return None
 
-        ## FIXME: Move this to SelectCommand.next_result()
-        result = []
-
-        # If there is extra_select prepend values to the results list
-        for col, query in self.last_select_command.extra_select.items():
-            result.append(entity.get(col))
-
-        for col in self.last_select_command.queried_fields:
-            if col == "__key__":
-                key = entity if isinstance(entity, Key) else entity.key()
-                self.returned_ids.append(key)
-                result.append(key.id_or_name())
-            else:
-                field = get_field_from_column(self.last_select_command.model, col)
-                value = self.connection.ops.convert_values(entity.get(col), field)
-                result.append(value)
-
-        return result
+        return self._entity_to_row(entity)
 
     def fetchmany(self, size, delete_flag=False):
         if not self.last_select_command.results:
             return []
 
-        result = []
-        i = 0
-        while i < size:
-            entity = self.fetchone(delete_flag)
-            if entity is None:
-                break
+        if isinstance(self.last_select_command.results, (int, long)):
+            return [ self.fetchone(delete_flag) for i in xrange(size) ]
 
-            result.append(entity)
-            i += 1
+        # Read the whole batch of entities first, and then convert them all
+        entities = []
+        next_result = self.last_select_command.next_result
+        try:
+            while len(entities) < size:
+                entity = next_result()
+                if entity is None:
+                    break
+                entities.append(entity)
+        except StopIteration:
+            pass
 
-        return result
+        entity_to_row = self._entity_to_row
+        return [ entity_to_row(x) for x in entities ]
 
     @property
     def lastrowid(self):
-        return self.returned_ids[-1].id_or_name()
+        return self.last_returned_id.id_or_name()
 
     def __iter__(self):
         return self
@@ -178,33 +192,54 @@ class DatabaseOperations(BaseDatabaseOperations):
 
     def convert_values(self, value, field):
         """ Called when returning values from the datastore"""
-
-        value = super(DatabaseOperations, self).convert_values(value, field)
+        return self.get_value_converter(field)(value)
+
+    def get_value_converter(self, field):
+        """
+            Returns a function which converts values of the field returned from the datastore,
+            in the same way as convert_values. All the decisions which only depend on the
+            field are made up front, so the returned function can be cheaply applied to every row.
+        """
+        if field is None:
+            return lambda value: value
+
+        # This is what BaseDatabaseOperations.convert_values does
+        internal_type = field.get_internal_type()
+        if internal_type == 'FloatField':
+            cast = float
+        elif internal_type and (internal_type.endswith('IntegerField') or internal_type == 'AutoField'):
+            cast = int
+        else:
+            cast = None
 
         db_type = field.db_type(self.connection)
-        if db_type == 'string' and isinstance(value, str):
-            value = value.decode("utf-8")
+        if db_type == 'string':
+            convert = lambda value: value.decode("utf-8") if isinstance(value, str) else value
         elif db_type == "datetime":
-            value = self.connection.ops.value_from_db_datetime(value)
+            convert = self.value_from_db_datetime
         elif db_type == "date":
-            value = self.connection.ops.value_from_db_date(value)
+            convert = self.value_from_db_date
         elif db_type == "time":
-            value = self.connection.ops.value_from_db_time(value)
+            convert = self.value_from_db_time
         elif db_type == "decimal":
-            value = self.connection.ops.value_from_db_decimal(value)
+            convert = self.value_from_db_decimal
         elif db_type == 'list':
-            if not value:
-                value = [] # Convert None back to an empty list
+            convert = lambda value: value or [] # Convert None back to an empty list
         elif db_type == 'set':
-            if not value:
-                value = set()
-            else:
-                value = set(value)
+            convert = lambda value: set(value) if value else set()
+        else:
+            convert = None
 
-        return value
+        if cast and convert:
+            return lambda value: convert(value if value is None else cast(value))
+        elif cast:
+            return lambda value: value if value is None else cast(value)
+        elif convert:
+            return convert
+        return lambda value: value
 
     def sql_flush(self, style, tables, seqs, allow_cascade=False):
-        return [ FlushCommand(table) for table in tables ]
+        return [ FlushCommand(tables) ] if tables else []
 
     def prep_lookup_key(self, model, value, field):
         if isinstance(value, basestring):
@@ -1,7 +1,13 @@
+import hashlib
 import logging
 import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from google.appengine.api import datastore
+from google.appengine.api import datastore, namespace_manager
+from google.appengine.datastore import datastore_query
 
 from django.conf import settings
 from django.core.cache import cache
@@ -9,15 +15,60 @@ from django.core.signals import request_finished, request_started
 from django.dispatch import receiver
 from djangae.db import utils
 from djangae.db.unique_utils import unique_identifiers_from_entity, _format_value_for_identifier
-from djangae.db.backends.appengine.context import ContextStack
+from djangae.db.backends.appengine.context import ContextStack, EntitySnapshot
 
 logger = logging.getLogger("djangae")
 
 _context = threading.local()
+_memcache_clients = threading.local()
 
 CACHE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_TIMEOUT_SECONDS", 60 * 60)
 CACHE_ENABLED = getattr(settings, "DJANGAE_CACHE_ENABLED", True)
 
+# Limits on the size of the context cache, the least recently used entities are evicted past either
+# of these. The size in bytes is an estimate. None means no limit
+CONTEXT_CACHE_MAX_ENTITIES = getattr(settings, "DJANGAE_CONTEXT_CACHE_MAX_ENTITIES", 10000)
+CONTEXT_CACHE_MAX_BYTES = getattr(settings, "DJANGAE_CONTEXT_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+
+# Lookups which find nothing are remembered for this long, so that repeatedly looking for
+# something which doesn't exist doesn't hit the datastore every time
+CACHE_MISSING_ENABLED = getattr(settings, "DJANGAE_CACHE_MISSING_ENABLED", True)
+CACHE_MISSING_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_MISSING_TIMEOUT_SECONDS", 10)
+
+# Reads only write what they fetched back to memcache if nothing has been written since they
+# missed, see _take_leases. Writes inside a transaction lock their identifiers until it's over
+LEASE_TIMEOUT_SECONDS = 5
+LOCK_TIMEOUT_SECONDS = 60
+
+# The number of leases remembered per request, reads which never finish leave theirs behind
+MAX_LEASES = 1000
+
+# The number of entities remembered per request for skipping saves which don't change anything
+MAX_SNAPSHOTS = 1000
+
+AUTO_BATCH_GETS = getattr(settings, "DJANGAE_AUTO_BATCH_GETS", False)
+AUTO_BATCH_MAX_KEYS = 500
+
+QUERY_CURSORS_ENABLED = getattr(settings, "DJANGAE_CACHE_QUERY_CURSORS", False)
+QUERY_CURSORS_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_QUERY_CURSORS_TIMEOUT_SECONDS", 60 * 5)
+QUERY_CURSORS_MIN_OFFSET = 100
+QUERY_CURSORS_MAX_PER_QUERY = 50
+
+# Enabling the query cache is done per model, see commands.query_cache_enabled
+QUERY_CACHE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_QUERIES_TIMEOUT_SECONDS", 60)
+QUERY_CACHE_MAX_RESULTS = 1000
+
+
+# Stored in memcache in place of an entity which is known not to exist
+TOMBSTONE = "__djangae_tombstone__"
+
+# Stored in memcache by the lease protocol, leases are this prefix followed by a unique id
+LEASE_PREFIX = "__djangae_lease__"
+LOCK = "__djangae_lock__"
+
+# Returned by the cache lookups in place of an entity which is known not to exist
+MISSING = object()
+
 
 class CachingSituation:
     DATASTORE_GET = 0
@@ -25,14 +76,22 @@ class CachingSituation:
     DATASTORE_GET_PUT = 2 # When we are doing an update
 
 
+def new_context_stack():
+    return ContextStack(max_entities=CONTEXT_CACHE_MAX_ENTITIES, max_bytes=CONTEXT_CACHE_MAX_BYTES)
+
+
 def ensure_context():
     _context.memcache_enabled = getattr(_context, "memcache_enabled", True)
     _context.context_enabled = getattr(_context, "context_enabled", True)
-    _context.stack = _context.stack if hasattr(_context, "stack") else ContextStack()
+    _context.stack = _context.stack if hasattr(_context, "stack") else new_context_stack()
+    _context.pending_gets = getattr(_context, "pending_gets", {})
+    _context.snapshots = getattr(_context, "snapshots", OrderedDict())
+    _context.leases = getattr(_context, "leases", OrderedDict())
 
 
-def _add_entity_to_memcache(model, entity, identifiers):
-    cache.set_many({ x: entity for x in identifiers}, timeout=CACHE_TIMEOUT_SECONDS)
+def _add_entities_to_memcache(entities_by_identifier):
+    if entities_by_identifier:
+        cache.set_many(entities_by_identifier, timeout=CACHE_TIMEOUT_SECONDS)
 
 
 def _get_cache_key_and_model_from_datastore_key(key):
@@ -50,34 +109,153 @@ def _get_cache_key_and_model_from_datastore_key(key):
 
 
 def _remove_entity_from_memcache_by_key(key):
+    _remove_entities_from_memcache_by_keys([key])
+
+
+def _remove_entities_from_memcache_by_keys(keys):
     """
         Note, if the key of the entity got evicted from the cache, it's possible that stale cache
         entries would be left behind. Remember if you need pure atomicity then use disable_cache() or a
         transaction.
     """
+    cache_keys = dict(_get_cache_key_and_model_from_datastore_key(x) for x in keys)
+    if not cache_keys:
+        return
 
-    cache_key, model = _get_cache_key_and_model_from_datastore_key(key)
-    entity = cache.get(cache_key)
+    identifiers = []
+    for cache_key, entity in cache.get_many(cache_keys.keys()).iteritems():
+        if _is_placeholder(entity):
+            identifiers.append(cache_key)
+        elif entity:
+            identifiers.extend(unique_identifiers_from_entity(cache_keys[cache_key], entity))
 
-    if entity:
-        identifiers = unique_identifiers_from_entity(model, entity)
-        cache.delete_many(identifiers)
+    remove_identifiers_from_memcache(identifiers)
+
+
+def _is_placeholder(value):
+    # Tombstones, leases and locks are strings, entities never are
+    return isinstance(value, basestring)
+
+
+def _from_memcache(value):
+    if _is_placeholder(value):
+        return MISSING if value == TOMBSTONE else None
+    return value
+
+
+def _memcache_client():
+    """
+        Returns a memcache client which supports compare-and-set, or None if the cache backend
+        isn't App Engine's memcache. Each thread has its own, because the client remembers
+        the values it has fetched for cas.
+    """
+    if not hasattr(_memcache_clients, "client"):
+        lib = getattr(cache, "_lib", None)
+        if lib is not None and hasattr(lib.Client, "cas_multi"):
+            _memcache_clients.client = lib.Client(cache._servers)
+        else:
+            _memcache_clients.client = None
+
+    return _memcache_clients.client
+
+
+def _leases_enabled():
+    return _context.memcache_enabled and not datastore.IsInTransaction() and _memcache_client() is not None
+
+
+def _take_leases(identifiers):
+    """
+        Before reading something from the datastore which wasn't in memcache, we add a lease for
+        it to memcache. Invalidating an identifier deletes (or locks) it, and caching a new
+        value overwrites it, so if our lease is still there when we come to cache what we
+        read then nothing has been written in the meantime. If something else is already
+        there (e.g. somebody else's lease, or a lock) then what we read isn't cached.
+    """
+    identifiers = list(identifiers)
+    if not identifiers or not _leases_enabled():
+        return
+
+    lease = LEASE_PREFIX + uuid.uuid4().hex
+    keys = { cache.make_key(x): x for x in identifiers }
+
+    not_added = set(_memcache_client().add_multi({ x: lease for x in keys }, time=LEASE_TIMEOUT_SECONDS))
+
+    leases = _context.leases
+    for key in keys:
+        if key not in not_added:
+            leases.pop(keys[key], None)
+            leases[keys[key]] = lease
+
+    # The oldest leases will have expired in memcache long before these are dropped
+    while len(leases) > MAX_LEASES:
+        leases.popitem(last=False)
+
+
+def _replace_leases(values_by_identifier, timeout):
+    """
+        Replaces our leases on the identifiers with the values, if the leases are still there.
+        Returns the identifiers which were set.
+    """
+    leases = { x: _context.leases.pop(x) for x in values_by_identifier if x in _context.leases }
+    if not leases or not _leases_enabled():
+        return set()
+
+    client = _memcache_client()
+    keys = { cache.make_key(x): x for x in leases }
+
+    current = client.get_multi(keys.keys(), for_cas=True)
+    ours = { k: values_by_identifier[keys[k]] for k, v in current.iteritems() if v == leases[keys[k]] }
+    if not ours:
+        return set()
+
+    not_set = set(client.cas_multi(ours, time=timeout))
+    return set(keys[x] for x in ours if x not in not_set)
+
+
+def _add_read_entities_to_memcache(identifiers_and_entities):
+    """
+        Caches entities which have been read from the datastore. An entity is only cached if we
+        hold a lease on one of its identifiers and it's still valid, in which case the rest of its
+        identifiers are only added if they aren't in memcache already.
+    """
+    leased = {}
+    for identifiers, entity in identifiers_and_entities:
+        leased.update({ x: entity for x in identifiers if x in _context.leases })
+
+    written = _replace_leases(leased, CACHE_TIMEOUT_SECONDS)
+
+    to_add = {}
+    for identifiers, entity in identifiers_and_entities:
+        if any(x in written for x in identifiers):
+            to_add.update({ cache.make_key(x): entity for x in identifiers if x not in written })
+
+    if to_add:
+        _memcache_client().add_multi(to_add, time=CACHE_TIMEOUT_SECONDS)
 
 
 def _get_entity_from_memcache(identifier):
-    return cache.get(identifier)
+    value = cache.get(identifier)
+    if value is None:
+        _take_leases([identifier])
+    return _from_memcache(value)
 
 
 def _get_entity_from_memcache_by_key(key):
     # We build the cache key for the ID of the instance
     cache_key, _ = _get_cache_key_and_model_from_datastore_key(key)
-    return cache.get(cache_key)
+    return _get_entity_from_memcache(cache_key)
 
 
 def add_entity_to_cache(model, entity, situation):
-    ensure_context()
+    add_entities_to_cache(model, [entity], situation)
 
-    identifiers = unique_identifiers_from_entity(model, entity)
+
+def add_entities_to_cache(model, entities, situation):
+    """
+        Adds the entities to the context cache and, if the situation allows it, to
+        memcache with a single set_many
+    """
+    ensure_context()
 
     # Don't cache on Get if we are inside a transaction, even in the context
     # This is because transactions don't see the current state of the datastore
@@ -85,19 +263,112 @@ def add_entity_to_cache(model, entity, situation):
     if situation == CachingSituation.DATASTORE_GET and datastore.IsInTransaction():
         return
 
+    # Only cache in memcache of we are doing a GET (outside a transaction) or PUT (outside a transaction)
+    # the exception is GET_PUT - which we do in our own transaction so we have to ignore that!
+    add_to_memcache = (
+        (not datastore.IsInTransaction() and situation in (CachingSituation.DATASTORE_GET, CachingSituation.DATASTORE_PUT)) or
+        situation == CachingSituation.DATASTORE_GET_PUT
+    )
+
     if situation in (CachingSituation.DATASTORE_PUT, CachingSituation.DATASTORE_GET_PUT) and datastore.IsInTransaction():
-        # We have to wipe the entity from memcache
-        if entity.key():
-            _remove_entity_from_memcache_by_key(entity.key())
+        # We have to wipe the entities from memcache
+        _remove_entities_from_memcache_by_keys([ x.key() for x in entities if x.key() ])
+
+        # The transaction might not commit, so we can't say what's in the datastore anymore
+        _remove_snapshots([ x.key() for x in entities ])
+    else:
+        add_snapshots(entities)
+
+    to_memcache = {}
+    to_remove = []
+    read = []
+    for entity in entities:
+        identifiers = unique_identifiers_from_entity(model, entity)
 
-    _context.stack.top.cache_entity(identifiers, entity, situation)
+        _context.stack.top.cache_entity(identifiers, entity, situation)
 
-    # Only cache in memcache of we are doing a GET (outside a transaction) or PUT (outside a transaction)
-    # the exception is GET_PUT - which we do in our own transaction so we have to ignore that!
-    if (not datastore.IsInTransaction() and situation in (CachingSituation.DATASTORE_GET, CachingSituation.DATASTORE_PUT)) or \
-            situation == CachingSituation.DATASTORE_GET_PUT:
+        if add_to_memcache and situation == CachingSituation.DATASTORE_GET and _memcache_client():
+            read.append((identifiers, entity))
+        elif add_to_memcache:
+            to_memcache.update({ x: entity for x in identifiers })
+        elif situation == CachingSituation.DATASTORE_PUT:
+            # Anything which was cached as missing under the new identifiers is about to exist
+            to_remove.extend(identifiers)
 
-        _add_entity_to_memcache(model, entity, identifiers)
+    _add_entities_to_memcache(to_memcache)
+    _add_read_entities_to_memcache(read)
+    remove_identifiers_from_memcache(to_remove)
+
+
+def add_entities_to_context(model, entities):
+    """
+        Adds the entities to the context cache only. This is for entities which
+        haven't been Put() yet, so mustn't be visible to anyone else
+    """
+    ensure_context()
+
+    for entity in entities:
+        identifiers = unique_identifiers_from_entity(model, entity)
+        _context.stack.top.cache_entity(identifiers, entity, CachingSituation.DATASTORE_PUT)
+
+    _remove_snapshots([ x.key() for x in entities ])
+
+
+def remove_identifiers_from_memcache(identifiers, lock=False):
+    """
+        Invalidates the identifiers in memcache. Inside a transaction they are locked until the
+        transaction is over so that nobody caches what they read in the meantime, otherwise
+        they are deleted. Either way, any leases on them are lost.
+
+        Pass lock=True to lock them outside a transaction too, for a write which hasn't finished
+        yet. The identifiers locked that way are returned, and must be passed to release_locks
+        once the write is done.
+    """
+    ensure_context()
+
+    identifiers = list(identifiers)
+    if not identifiers:
+        return []
+
+    if datastore.IsInTransaction():
+        _context.stack.top.locked.update(identifiers)
+        cache.set_many({ x: LOCK for x in identifiers }, timeout=LOCK_TIMEOUT_SECONDS)
+    elif lock:
+        cache.set_many({ x: LOCK for x in identifiers }, timeout=LOCK_TIMEOUT_SECONDS)
+        return identifiers
+    else:
+        cache.delete_many(identifiers)
+
+    return []
+
+
+def release_locks(identifiers):
+    """
+        Releases the locks taken by remove_identifiers_from_memcache inside a transaction. This
+        always deletes them, even if another (outer) transaction is still going on.
+    """
+    identifiers = list(identifiers)
+    if identifiers:
+        cache.delete_many(identifiers)
+
+
+@contextmanager
+def releasing_locks():
+    """
+        Releases the locks taken inside the block when it exits. Transactions started with the
+        SDK's db.transactional rather than atomic() don't have a context of their own to release
+        them, so without this they'd be held until they timed out.
+    """
+    ensure_context()
+
+    locked = _context.stack.top.locked
+    before = set(locked)
+    try:
+        yield
+    finally:
+        taken = locked - before
+        locked.difference_update(taken)
+        release_locks(taken)
 
 
 def remove_entity_from_cache(entity):
@@ -113,16 +384,97 @@ def remove_entity_from_cache_by_key(key, memcache_only=False):
     ensure_context()
 
     if not memcache_only:
-        for identifier in _context.stack.top.reverse_cache.get(key, []):
-            if identifier in _context.stack.top.cache:
-                del _context.stack.top.cache[identifier]
+        _context.stack.top.remove_entity(key)
+
+    _remove_snapshots([key])
 
     _remove_entity_from_memcache_by_key(key)
 
 
-def get_from_cache_by_key(key):
+def remove_entities_from_cache(model, entities, lock=False):
+    """
+        Removes the entities from the context cache, and from memcache with a single
+        delete_many. The identifiers are taken from the entities themselves, so there's
+        no need to read what's in memcache first. See remove_identifiers_from_memcache
+        for lock, the locked identifiers are returned.
+    """
+    ensure_context()
+
+    identifiers = set()
+    for entity in entities:
+        _context.stack.top.remove_entity(entity.key())
+
+        identifiers.update(unique_identifiers_from_entity(model, entity))
+
+    _remove_snapshots([ x.key() for x in entities ])
+    return remove_identifiers_from_memcache(identifiers, lock=lock)
+
+
+def remove_entities_from_cache_by_keys(keys, lock=False):
+    """
+        Removes the entities from the context cache, and from memcache with a single delete_many
+        without reading memcache first. This only works for models which have no unique fields other
+        than the primary key, as the other identifiers can't be worked out from the key alone.
+        See remove_identifiers_from_memcache for lock, the locked identifiers are returned.
+    """
+    ensure_context()
+
+    identifiers = []
+    for key in keys:
+        _context.stack.top.remove_entity(key)
+
+        identifiers.append(_get_cache_key_and_model_from_datastore_key(key)[0])
+
+    _remove_snapshots(keys)
+    return remove_identifiers_from_memcache(identifiers, lock=lock)
+
+
+def _tombstones_enabled():
+    # Gets inside a transaction don't see the current state of the datastore
+    return CACHE_ENABLED and CACHE_MISSING_ENABLED and not datastore.IsInTransaction()
+
+
+def add_tombstones(identifiers):
+    """
+        Records that nothing exists with the identifiers, in the context cache and for
+        CACHE_MISSING_TIMEOUT_SECONDS in memcache. The tombstones are replaced when an
+        entity is added to the cache with one of the identifiers.
+    """
+    ensure_context()
+
+    identifiers = list(identifiers)
+    if not identifiers or not _tombstones_enabled():
+        return
+
+    if _context.context_enabled:
+        _context.stack.top.add_tombstones(identifiers)
+
+    if _memcache_client():
+        _replace_leases({ x: TOMBSTONE for x in identifiers }, CACHE_MISSING_TIMEOUT_SECONDS)
+    elif _context.memcache_enabled:
+        cache.set_many({ x: TOMBSTONE for x in identifiers }, timeout=CACHE_MISSING_TIMEOUT_SECONDS)
+
+
+def add_missing_keys_to_cache(keys):
+    """
+        Records that the entities with the keys don't exist, see add_tombstones
+    """
+    add_tombstones(_get_cache_key_and_model_from_datastore_key(x)[0] for x in keys)
+
+
+def _get_from_context_by_key(key):
+    entity = _context.stack.top.get_entity_by_key(key)
+    if entity is None and _context.stack.top.tombstones:
+        if _context.stack.top.has_tombstone(_get_cache_key_and_model_from_datastore_key(key)[0]):
+            return MISSING
+    return entity
+
+
+def get_from_cache_by_key(key, include_missing=False):
     """
-        Return an entity from the context cache, falling back to memcache when possible
+        Return an entity from the context cache, falling back to memcache when possible. If
+        include_missing is True then MISSING is returned for an entity known not to exist,
+        otherwise None is returned for it.
     """
 
     ensure_context()
@@ -133,19 +485,160 @@ def get_from_cache_by_key(key):
     ret = None
     if _context.context_enabled:
         # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
-        ret = _context.stack.top.get_entity_by_key(key)
+        ret = _get_from_context_by_key(key)
         if ret is None and not datastore.IsInTransaction():
             if _context.memcache_enabled:
                 ret = _get_entity_from_memcache_by_key(key)
     elif _context.memcache_enabled and not datastore.IsInTransaction():
         ret = _get_entity_from_memcache_by_key(key)
 
+    if ret is MISSING and not include_missing:
+        ret = None
+
+    return ret
+
+
+def _get_entities_from_memcache_by_keys(keys):
+    cache_keys = { _get_cache_key_and_model_from_datastore_key(x)[0]: x for x in keys }
+    if not cache_keys:
+        return {}
+
+    values = cache.get_many(cache_keys.keys())
+    _take_leases(x for x in cache_keys if x not in values)
+
+    values = { cache_keys[k]: _from_memcache(v) for k, v in values.iteritems() }
+    return { k: v for k, v in values.iteritems() if v is not None }
+
+
+def get_from_cache_by_keys(keys, include_missing=False):
+    """
+        Return a dictionary of key -> entity for the keys found in the context cache, falling
+        back to a single memcache lookup for the remainder when possible. Keys which weren't
+        found in either cache are missing from the result. If include_missing is True then
+        keys of entities known not to exist are included, with MISSING as their value.
+    """
+
+    ensure_context()
+
+    if not CACHE_ENABLED:
+        return {}
+
+    ret = {}
+    if _context.context_enabled:
+        # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
+        for key in keys:
+            entity = _get_from_context_by_key(key)
+            if entity is not None:
+                ret[key] = entity
+
+    if _context.memcache_enabled and not datastore.IsInTransaction():
+        ret.update(_get_entities_from_memcache_by_keys([ x for x in keys if x not in ret ]))
+
+    if not include_missing:
+        ret = { k: v for k, v in ret.iteritems() if v is not MISSING }
+
+    return ret
+
+
+def _snapshots_enabled():
+    return CACHE_ENABLED and _context.context_enabled
+
+
+def add_snapshots(entities):
+    """
+        Remembers the entities as they were read from (or written to) the datastore during this
+        request, so that a save which wouldn't change anything can be skipped. Only pass entities
+        which came from a datastore Get or Put, query results and anything read back from memcache
+        may be stale. The entities are copied, so callers are free to modify them afterwards.
+    """
+    ensure_context()
+
+    if not _snapshots_enabled():
+        return
+
+    snapshots = _context.snapshots
+    for entity in entities:
+        key = entity.key()
+        if key.has_id_or_name():
+            snapshots.pop(key, None)
+            snapshots[key] = EntitySnapshot(entity)
+
+    while len(snapshots) > MAX_SNAPSHOTS:
+        snapshots.popitem(last=False)
+
+
+def get_snapshot(key):
+    """
+        Returns the entity as it was last read or written during this request, or None. Nothing
+        is returned inside a transaction, where the write has to happen for the transaction to
+        be consistent with whatever else it reads
+    """
+    ensure_context()
+
+    if not _snapshots_enabled() or datastore.IsInTransaction():
+        return None
+
+    snapshot = _context.snapshots.get(key)
+    return snapshot.entity() if snapshot is not None else None
+
+
+def _remove_snapshots(keys):
+    ensure_context()
+
+    for key in keys:
+        _context.snapshots.pop(key, None)
+
+
+def _auto_batching_enabled():
+    # Keys fetched along with the ones asked for only end up in the context cache, and Gets
+    # inside a transaction can't include other entity groups
+    return AUTO_BATCH_GETS and CACHE_ENABLED and _context.context_enabled and not datastore.IsInTransaction()
+
+
+def add_pending_gets(keys):
+    """
+        Remembers keys which are likely to be fetched soon, e.g. the targets of the foreign keys
+        of entities which have just been read, so that when one of them is fetched the others
+        can be fetched by the same Get. They are forgotten at the end of the request.
+    """
+    ensure_context()
+
+    if not _auto_batching_enabled():
+        return
+
+    for key in keys:
+        pending = _context.pending_gets.setdefault(key.kind(), set())
+        if len(pending) < AUTO_BATCH_MAX_KEYS:
+            pending.add(key)
+
+
+def pop_pending_gets(keys):
+    """
+        Returns the pending keys of the same kinds as keys, which aren't in the context cache
+        already, and forgets them. These should be fetched by the same Get as keys, and the
+        results added to the cache with add_entities_to_cache.
+    """
+    ensure_context()
+
+    if not _auto_batching_enabled():
+        return []
+
+    keys = set(keys)
+
+    ret = []
+    for kind in set(x.kind() for x in keys):
+        for key in _context.pending_gets.pop(kind, ()):
+            if key not in keys and key not in _context.stack.top.reverse_cache:
+                ret.append(key)
+
     return ret
 
 
-def get_from_cache(unique_identifier):
+def get_from_cache(unique_identifier, include_missing=False):
     """
-        Return an entity from the context cache, falling back to memcache when possible
+        Return an entity from the context cache, falling back to memcache when possible. If
+        include_missing is True then MISSING is returned when nothing exists with the
+        identifier, otherwise None is returned.
     """
 
     ensure_context()
@@ -157,12 +650,17 @@ def get_from_cache(unique_identifier):
     if _context.context_enabled:
         # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
         ret = _context.stack.top.get_entity(unique_identifier)
-        if ret is None and not datastore.IsInTransaction():
+        if ret is None and _context.stack.top.has_tombstone(unique_identifier):
+            ret = MISSING
+        elif ret is None and not datastore.IsInTransaction():
             if _context.memcache_enabled:
                 ret = _get_entity_from_memcache(unique_identifier)
     elif _context.memcache_enabled and not datastore.IsInTransaction():
         ret = _get_entity_from_memcache(unique_identifier)
 
+    if ret is MISSING and not include_missing:
+        ret = None
+
     return ret
 
 
@@ -178,7 +676,7 @@ def reset_context(keep_disabled_flags=False, *args, **kwargs):
     memcache_enabled = getattr(_context, "memcache_enabled", True)
     context_enabled = getattr(_context, "context_enabled", True)
 
-    for attr in ("stack", "memcache_enabled", "context_enabled"):
+    for attr in ("stack", "memcache_enabled", "context_enabled", "pending_gets", "snapshots", "leases"):
         if hasattr(_context, attr):
             delattr(_context, attr)
 
@@ -187,3 +685,145 @@ def reset_context(keep_disabled_flags=False, *args, **kwargs):
     if keep_disabled_flags:
         _context.memcache_enabled = memcache_enabled
         _context.context_enabled = context_enabled
+
+
+def query_signature(query):
+    """
+        Returns a string which identifies the results of a datastore Query. Two queries
+        with the same signature will return the same results in the same order.
+    """
+    options = query._Query__query_options
+
+    return hashlib.md5(repr((
+        namespace_manager.get_namespace(),
+        query._Query__kind,
+        sorted((k, repr(v)) for k, v in query.iteritems()),
+        list(query._Query__orderings),
+        options.projection,
+        options.keys_only
+    ))).hexdigest()
+
+
+def _query_cursors_cache_key(query):
+    return "|".join(["djangae-cursors", query_signature(query)])
+
+
+def get_nearest_query_cursor(query, offset):
+    """
+        Returns a (position, cursor) tuple for the closest stored cursor for this query
+        which isn't beyond offset, or (0, None) if there isn't one
+    """
+    ensure_context()
+
+    if not (CACHE_ENABLED and QUERY_CURSORS_ENABLED and _context.memcache_enabled) or datastore.IsInTransaction():
+        return 0, None
+
+    cursors = cache.get(_query_cursors_cache_key(query)) or {}
+    positions = [ x for x in cursors if x <= offset ]
+    if not positions:
+        return 0, None
+
+    position = max(positions)
+    return position, datastore_query.Cursor.from_websafe_string(cursors[position])
+
+
+def store_query_cursor(query, position, cursor):
+    """
+        Remember the cursor at position in the results of query, so that later queries
+        which skip at least that many results can start from there rather than reading
+        (and paying for) all the skipped entities
+    """
+    ensure_context()
+
+    if not (CACHE_ENABLED and QUERY_CURSORS_ENABLED and _context.memcache_enabled) or datastore.IsInTransaction():
+        return
+
+    if position < QUERY_CURSORS_MIN_OFFSET or cursor is None:
+        return
+
+    cache_key = _query_cursors_cache_key(query)
+    cursors = cache.get(cache_key) or {}
+    if position in cursors:
+        return
+
+    cursors[position] = cursor.to_websafe_string()
+    while len(cursors) > QUERY_CURSORS_MAX_PER_QUERY:
+        del cursors[min(cursors)]
+
+    cache.set(cache_key, cursors, timeout=QUERY_CURSORS_TIMEOUT_SECONDS)
+
+
+def _query_generation_cache_key(kind):
+    return "|".join(["djangae-query-generation", namespace_manager.get_namespace(), kind])
+
+
+def _query_results_cache_key(query, limit, offset):
+    return "|".join(["djangae-query", query_signature(query), str(limit), str(offset or 0)])
+
+
+def _query_cache_enabled():
+    return CACHE_ENABLED and _context.memcache_enabled and not datastore.IsInTransaction()
+
+
+def get_query_results(query, limit, offset):
+    """
+        Returns a (keys, generation) tuple. keys is the list of keys stored for the results of the
+        query, or None if there aren't any which are still valid. In that case the query should be
+        run and its keys stored with store_query_results(query, limit, offset, generation, keys).
+        The generation is read before the query is run, so a write made while it runs will
+        invalidate what's stored.
+    """
+    ensure_context()
+
+    if not _query_cache_enabled():
+        return None, None
+
+    generation_key = _query_generation_cache_key(query._Query__kind)
+    results_key = _query_results_cache_key(query, limit, offset)
+
+    values = cache.get_many([generation_key, results_key])
+
+    generation = values.get(generation_key)
+    if generation is None:
+        # Start from the time rather than zero, so if the generation is evicted from memcache
+        # results which were stored against its old value don't become valid again
+        generation = int(time.time() * 1000000)
+        if not cache.add(generation_key, generation, timeout=CACHE_TIMEOUT_SECONDS):
+            generation = cache.get(generation_key)
+        return None, generation
+
+    stored = values.get(results_key)
+    if stored is not None and stored[0] == generation:
+        return stored[1], generation
+
+    return None, generation
+
+
+def store_query_results(query, limit, offset, generation, keys):
+    ensure_context()
+
+    if generation is None or not _query_cache_enabled():
+        return
+
+    cache.set(_query_results_cache_key(query, limit, offset), (generation, keys), timeout=QUERY_CACHE_TIMEOUT_SECONDS)
+
+
+def invalidate_queries(kind):
+    """
+        Invalidates the stored results of every query on the kind, by moving its generation on.
+        Inside a transaction this is done when the transaction commits.
+    """
+    ensure_context()
+
+    if not CACHE_ENABLED:
+        return
+
+    if datastore.IsInTransaction():
+        _context.stack.top.written_kinds.add(kind)
+        return
+
+    try:
+        cache.incr(_query_generation_cache_key(kind))
+    except ValueError:
+        # There's no generation, so nothing has been stored since it was evicted
+        pass
@@ -2,23 +2,31 @@
 from datetime import datetime
 import logging
 import copy
+import sys
+import threading
+import heapq
+from collections import deque, OrderedDict
 import re
-from functools import partial
-from itertools import chain, groupby
+from itertools import chain, groupby, islice, izip_longest
 
 #LIBRARIES
 from django.db import DatabaseError
 from django.core.exceptions import FieldError
 from django.db.models.fields import FieldDoesNotExist
 
+from django.conf import settings
 from django.core.cache import cache
+from django.core.signals import request_finished
+from django.dispatch import receiver
 from django.db import IntegrityError
 from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.sql import query
 from django.db.models.sql.where import EmptyWhere
 from django.db.models.fields import AutoField
+from django.db.models.fields.related import ForeignKey
 from google.appengine.api import datastore, datastore_errors
 from google.appengine.api.datastore import Query
+from google.appengine.datastore.datastore_rpc import TransactionOptions
 from google.appengine.ext import db
 
 #DJANGAE
@@ -36,7 +44,7 @@ from djangae.indexing import special_indexes_for_column, REQUIRES_SPECIAL_INDEXE
 from djangae.utils import on_production, memoized
 from djangae.db import constraints, utils
 from djangae.db.backends.appengine import caching
-from djangae.db.unique_utils import query_is_unique
+from djangae.db.unique_utils import query_is_unique, unique_identifiers_from_entity, _unique_combinations
 from djangae.db.backends.appengine import transforms
 from djangae.db.caching import clear_context_cache
 
@@ -84,6 +92,41 @@ REVERSE_OP_MAP = {
 
 INEQUALITY_OPERATORS = frozenset(['>', '<', '<=', '>='])
 
+# The number of keys read from a keys_only query before the entities are looked up
+KEYS_THEN_GET_BATCH_SIZE = 100
+
+# The number of keys fetched by each Get when looking up entities by key, and the
+# number of those Gets which can be running at once
+QUERY_BY_KEYS_CHUNK_SIZE = 500
+QUERY_BY_KEYS_MAX_IN_FLIGHT = 10
+
+# The number of values a distinct query remembers when it can't rely on the ordering
+MAX_DISTINCT_VALUES = 10000
+
+# The maximum number of entity groups a cross-group transaction can touch
+MAX_ENTITY_GROUPS_PER_TRANSACTION = 25
+
+# The number of update transactions which can be running at once
+UPDATE_CONCURRENCY = getattr(settings, "DJANGAE_UPDATE_CONCURRENCY", 10)
+
+# The number of entities read and written by each Get/Put of a bulk update
+BULK_UPDATE_BATCH_SIZE = 500
+
+# The number of keys removed by each Delete of a delete query, and the number of
+# those Deletes which can be running at once
+DELETE_BATCH_SIZE = 500
+DELETE_MAX_IN_FLIGHT = 10
+
+# The number of ids allocated at a time for new entities inside batch_writes(), and the
+# maximum number of entities written by each of its Puts
+WRITE_BATCH_ID_BLOCK_SIZE = 100
+WRITE_BATCH_PUT_SIZE = 500
+
+# The number of keys removed by each Delete when flushing tables, and the number
+# of those Deletes which can be running at once
+FLUSH_BATCH_SIZE = 500
+FLUSH_MAX_IN_FLIGHT = 10
+
 def _cols_from_where_node(where_node):
     cols = where_node.get_cols() if hasattr(where_node, 'get_cols') else where_node.get_group_by_cols()
     return cols
@@ -279,6 +322,48 @@ def _convert_entity_based_on_query_options(entity, opts):
 def _get_key(query):
     return query["__key__ ="]
 
+
+def _ordering_with_key(ordering):
+    """
+        The datastore orders results with the same values by key, so do the same
+        when ordering in memory
+    """
+    if any(order == "__key__" for order, direction in ordering):
+        return ordering
+    return list(ordering) + [("__key__", Query.ASCENDING)]
+
+
+def _merge_sorted(iterators, sort_key):
+    """
+        Lazily k-way merges already sorted iterators into a single sorted stream,
+        only ever holding one pending result per iterator.
+    """
+    heap = []
+    for i, iterator in enumerate(iterators):
+        for result in iterator:
+            heap.append((sort_key(result), i, result, iterator))
+            break
+
+    heapq.heapify(heap)
+
+    while heap:
+        _, i, result, iterator = heap[0]
+        yield result
+
+        for result in iterator:
+            heapq.heapreplace(heap, (sort_key(result), i, result, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _found(cached):
+    """
+        Returns the entities from a get_from_cache_by_keys(..., include_missing=True) result
+    """
+    return [ x for x in cached.itervalues() if x is not caching.MISSING ]
+
+
 class QueryByKeys(object):
     def __init__(self, model, queries, ordering):
         self.model = model
@@ -287,43 +372,88 @@ class QueryByKeys(object):
         self.ordering = ordering
         self._Query__kind = queries[0]._Query__kind
 
+    def _add_fetched_to_cache(self, cached, missing, fetched):
+        caching.add_missing_keys_to_cache([ key for key, entity in zip(missing, fetched) if entity is None ])
+
+        fetched = [ x for x in fetched if x is not None ]
+        caching.add_entities_to_cache(self.model, fetched, caching.CachingSituation.DATASTORE_GET)
+        return _found(cached) + fetched
+
+    def _fetch_chunks(self, keys):
+        """
+            Yields lists of entities for the keys, a chunk of keys at a time. Each chunk
+            is read from the cache where possible, and the misses are fetched with async
+            Gets so that several chunks are being fetched at once.
+        """
+        chunks = [ keys[i:i + QUERY_BY_KEYS_CHUNK_SIZE] for i in xrange(0, len(keys), QUERY_BY_KEYS_CHUNK_SIZE) ]
+
+        if len(chunks) == 1:
+            # No need for the async machinery for the common case
+            cached = caching.get_from_cache_by_keys(keys, include_missing=True)
+            cached.update(_get_queued_entities(keys))
+            missing = [ x for x in keys if x not in cached ]
+            if not missing:
+                yield _found(cached)
+                return
+
+            # Fetch any keys we're expecting to be asked for soon in the same Get, they are
+            # only added to the cache so that the next lookup finds them
+            pending = caching.pop_pending_gets(missing)
+            fetched = datastore.Get(missing + pending)
+            if pending:
+                prefetched = [ x for x in fetched[len(missing):] if x is not None ]
+                caching.add_entities_to_cache(self.model, prefetched, caching.CachingSituation.DATASTORE_GET)
+
+            yield self._add_fetched_to_cache(cached, missing, fetched[:len(missing)])
+            return
+
+        in_flight = deque()
+        for chunk in chunks:
+            cached = caching.get_from_cache_by_keys(chunk, include_missing=True)
+            cached.update(_get_queued_entities(chunk))
+            missing = [ x for x in chunk if x not in cached ]
+            in_flight.append((cached, missing, datastore.GetAsync(missing) if missing else None))
+
+            if len(in_flight) == QUERY_BY_KEYS_MAX_IN_FLIGHT:
+                cached, missing, rpc = in_flight.popleft()
+                yield self._add_fetched_to_cache(cached, missing, rpc.get_result() if rpc else [])
+
+        while in_flight:
+            cached, missing, rpc = in_flight.popleft()
+            yield self._add_fetched_to_cache(cached, missing, rpc.get_result() if rpc else [])
+
     def Run(self, limit=None, offset=None):
         assert not self.queries[0]._Query__ancestor_pb #FIXME: We don't handle this yet
 
         # FIXME: What if the query options differ?
         opts = self.queries[0]._Query__query_options
 
-        results = None
+        chunks = self._fetch_chunks(self.queries_by_key.keys())
 
-        # If we have a single key lookup going on, just hit the cache
-        if len(self.queries_by_key) == 1:
-            keys = self.queries_by_key.keys()
-            ret = caching.get_from_cache_by_key(keys[0])
-            if ret is not None:
-                results = [ret]
+        if self.ordering:
+            # Every chunk is needed before the first result is known, so sort each of them and then merge
+            ordering = _ordering_with_key(self.ordering)
+            results = _merge_sorted(
+                [ iter(utils.sort_entities(x, ordering)) for x in chunks ],
+                utils.compile_sort_key(ordering)
+            )
+        else:
+            # Without an ordering we can return the results as each chunk arrives
+            results = chain.from_iterable(chunks)
 
-        # If there was nothing in the cache, or we had more than one key, then use Get()
-        if results is None:
-            keys = self.queries_by_key.keys()
-            results = datastore.Get(keys)
-            for result in results:
-                if result is None:
-                    continue
-                caching.add_entity_to_cache(self.model, result, caching.CachingSituation.DATASTORE_GET)
-            results = sorted((x for x in results if x is not None), cmp=partial(utils.django_ordering_comparison, self.ordering))
+        # Queries which only differ by key share a matcher, so usually there is just one
+        matchers_by_key = {
+            key: set(utils.compile_query_matcher(x) for x in queries)
+            for key, queries in self.queries_by_key.iteritems()
+        }
 
-        results = [
+        results = (
             _convert_entity_based_on_query_options(x, opts)
-            for x in results if any([ utils.entity_matches_query(x, qry) for qry in self.queries_by_key[x.key()]])
-        ]
-
-        if offset:
-            results = results[offset:]
-
-        if limit is not None:
-            results = results[:limit]
+            for x in results if any(matcher(x) for matcher in matchers_by_key[x.key()])
+        )
 
-        return iter(results)
+        offset = offset or 0
+        return islice(results, offset, None if limit is None else offset + limit)
 
     def Count(self, limit, offset):
         return len([ x for x in self.Run(limit, offset) ])
@@ -352,28 +482,111 @@ class UniqueQuery(object):
         if opts.keys_only or opts.projection:
             return self._gae_query.Run(limit=limit, offset=offset)
 
-        ret = caching.get_from_cache(self._identifier)
-        if ret is not None and not utils.entity_matches_query(ret, self._gae_query):
+        matcher = utils.compile_query_matcher(self._gae_query)
+
+        ret = caching.get_from_cache(self._identifier, include_missing=True)
+        if ret is caching.MISSING:
+            return iter([])
+
+        if ret is not None and not matcher(ret):
             ret = None
 
         if ret is None:
             # We do a fast keys_only query to get the result
             keys_query = Query(self._gae_query._Query__kind, keys_only=True)
             keys_query.update(self._gae_query)
-            keys = keys_query.Run(limit=limit, offset=offset)
+            keys = list(keys_query.Run(limit=limit, offset=offset))
+
+            # The query is eventually consistent, so finding nothing doesn't mean nothing exists. If
+            # the model has unique markers we fetch the marker in the same Get, if there isn't one
+            # then nothing exists with the identifier and we can remember that
+            marker_key = None
+            if not keys and self._can_confirm_missing():
+                marker_key = datastore.Key.from_path(constraints.UniqueMarker.kind(), self._identifier)
 
             # Do a consistent get so we don't cache stale data, and recheck the result matches the query
-            ret = [ x for x in datastore.Get(keys) if x and utils.entity_matches_query(x, self._gae_query) ]
+            fetched = datastore.Get(keys + [ marker_key ] if marker_key else keys)
+            if marker_key and fetched[-1] is None:
+                caching.add_tombstones([ self._identifier ])
+                return iter([])
+
+            ret = matcher.filter(x for x in fetched if x)
             if len(ret) == 1:
                 caching.add_entity_to_cache(self._model, ret[0], caching.CachingSituation.DATASTORE_GET)
             return iter(ret)
 
         return iter([ ret ])
 
+    def _can_confirm_missing(self):
+        if not caching.CACHE_MISSING_ENABLED or datastore.IsInTransaction():
+            return False
+
+        # Markers aren't acquired for the primary key on its own
+        fields = [ x.split(":", 1)[0] for x in self._identifier.split("|")[1:] ]
+        return constraints.constraint_checks_enabled(self._model) and fields != [ "__key__" ]
+
     def Count(self, limit, offset):
         return sum(1 for x in self.Run(limit, offset))
 
 
+class AsyncMultiQuery(datastore.MultiQuery):
+    """
+        Replacement for datastore.MultiQuery. Rather than running each subquery
+        in turn, all of the subqueries are started before any results are read
+        so that their RPCs are in flight at the same time. The result streams are then
+        lazily merged in the requested order, skipping entities which were
+        returned by more than one subquery.
+    """
+
+    def __init__(self, queries, ordering):
+        super(AsyncMultiQuery, self).__init__(queries, ordering)
+        self.queries = queries
+        self.ordering = ordering
+
+    def _merge(self, iterators):
+        if self.ordering:
+            results = _merge_sorted(iterators, utils.compile_sort_key(_ordering_with_key(self.ordering)))
+        else:
+            results = chain(*iterators)
+
+        seen = set()
+        for result in results:
+            key = result if isinstance(result, datastore.Key) else result.key()
+            if key in seen:
+                continue
+
+            seen.add(key)
+            yield result
+
+    def _run_all(self, queries, limit, offset):
+        # Any subquery could provide all of the results before the offset,
+        # so each of them needs to return up to offset + limit results
+        fetch = None if limit is None else (offset or 0) + limit
+
+        # Query.Run() sends the RPC for the first batch immediately, so by
+        # doing this before iterating any results all the subqueries run concurrently
+        return [ query.Run(limit=fetch) for query in queries ]
+
+    def Run(self, limit=None, offset=None, **kwargs):
+        offset = offset or 0
+        results = self._merge(self._run_all(self.queries, limit, offset))
+        return islice(results, offset, None if limit is None else offset + limit)
+
+    def Count(self, limit=1000, offset=None, **kwargs):
+        offset = offset or 0
+
+        # We only need the keys to count unique results, and ordering doesn't matter
+        keys_queries = []
+        for query in self.queries:
+            keys_query = Query(query._Query__kind, keys_only=True)
+            keys_query.update(query)
+            keys_queries.append(keys_query)
+
+        count = len(set(chain(*self._run_all(keys_queries, limit, offset)))) - offset
+        count = max(count, 0)
+        return count if limit is None else min(count, limit)
+
+
 def _convert_ordering(query):
     if not query.default_ordering:
         result = query.order_by
@@ -488,31 +701,104 @@ def _apply_extra_to_entity(extra_select, entity, pk_col):
 
     return entity
 
-class SelectCommand(object):
-    def __init__(self, connection, query, keys_only=False):
-        self.where = None
+# The value independent parts of a SelectCommand (ordering, selected fields, projection etc.)
+# are cached against the shape of the Django query. See _query_plan_key()
+MAX_QUERY_PLAN_CACHE_SIZE = 1000
 
-        self.original_query = query
-        self.connection = connection
+_query_plan_cache = {}
 
-        self.limits = (query.low_mark, query.high_mark)
-        self.results_returned = 0
 
+def _where_shape(node):
+    """
+        Returns a hashable representation of a Django WHERE tree with the values stripped
+        out, or None if the tree contains something we can't represent (e.g. a subquery)
+    """
+    if hasattr(node, "children"):
+        children = []
+        for child in node.children:
+            shape = _where_shape(child)
+            if shape is None:
+                return None
+            children.append(shape)
+        return (type(node).__name__, node.connector, node.negated, tuple(children))
+
+    if isinstance(node, tuple):
+        # Django <= 1.6, (Constraint, lookup_type, annotation, value)
+        constraint, lookup_type, annotation, value = node
+        if isinstance(value, query.Query) or not hasattr(constraint, "col"):
+            return None
+        return (constraint.alias, constraint.col, lookup_type)
+
+    # Django 1.7+ Lookup
+    lhs = getattr(node, "lhs", None)
+    if lhs is None or not hasattr(lhs, "alias") or isinstance(node.rhs, query.Query):
+        return None
+    return (lhs.alias, lhs.target.column, node.lookup_name)
+
+
+def _query_plan_key(connection, query, keys_only):
+    """
+        Returns a key representing the shape of the query, or None if the query
+        can't be planned by shape alone. Plans contain things derived from the
+        connection (e.g. db_type) so they are kept separate per database.
+    """
+    where = _where_shape(query.where)
+    if where is None:
+        return None
+
+    select = []
+    for x in query.select:
+        if hasattr(x, "field"):
+            if x.field is None:
+                select.append((x.col.col, x.col.lookup_type))
+            else:
+                select.append(x.field.column)
+        else:
+            select.append(x[1])
+
+    key = (
+        connection.alias,
+        query.model,
+        keys_only,
+        tuple(select),
+        frozenset(query.deferred_loading[0]),
+        query.deferred_loading[1],
+        tuple(query.order_by),
+        tuple(query.extra_order_by),
+        query.default_ordering,
+        tuple((k, v[0]) for k, v in query.extra_select.items()),
+        query.distinct,
+        where,
+    )
+
+    try:
+        hash(key)
+    except TypeError:
+        return None
+
+    return key
+
+
+class QueryPlan(object):
+    """
+        The parts of a SelectCommand which only depend on the shape of the query, and so
+        can be shared between queries which only differ by the values they filter on.
+    """
+
+    def __init__(self, connection, query, keys_only):
         opts = query.get_meta()
+        model = query.model
+        pk_col = opts.pk.column
 
-        self.distinct = query.distinct
-        self.distinct_values = set()
+        self.unsupported_query_message = ""
         self.distinct_on_field = None
-        self.distinct_field_convertor = None
+        self.distinct_lookup_type = None
         self.queried_fields = []
-        self.model = query.model
-        self.pk_col = opts.pk.column
-        self.is_count = query.aggregates
-        self.extra_select = query.extra_select
-        self._set_db_table()
+        self.ordering = []
+        self.keys_only = keys_only
+        self.projection = None
 
         try:
-            self._validate_query_is_possible(query)
             self.ordering = _convert_ordering(query)
         except NotSupportedError as e:
             # If we can detect here, or when parsing the WHERE tree that a query is unsupported
@@ -521,15 +807,12 @@ class SelectCommand(object):
             # only need to catch that one, and not both Django's and ours
             self.unsupported_query_message = str(e)
             return
-        else:
-            self.unsupported_query_message = ""
-
 
         # If the query uses defer()/only() then we need to process deferred. We have to get all deferred columns
         # for all (concrete) inherited models and then only include columns if they appear in that list
         deferred_columns = {}
         query.deferred_to_data(deferred_columns, query.deferred_to_columns_cb)
-        inherited_db_tables = [x._meta.db_table for x in get_concrete_parents(self.model)]
+        inherited_db_tables = [x._meta.db_table for x in get_concrete_parents(model)]
         only_load = list(chain(*[list(deferred_columns.get(x, [])) for x in inherited_db_tables]))
 
         if query.select:
@@ -548,7 +831,7 @@ class SelectCommand(object):
                         # in our transform function. The transform is applied when the results are read back so that only distinct values are returned.
                         # this is very hacky...
                         if lookup_type in DATE_TRANSFORMS:
-                            self.distinct_field_convertor = lambda value: DATE_TRANSFORMS[lookup_type](self.connection, value)
+                            self.distinct_lookup_type = lookup_type
                         else:
                             raise CouldBeSupportedError("Unhandled lookup_type %s" % lookup_type)
                     else:
@@ -563,9 +846,9 @@ class SelectCommand(object):
         else:
             # If no specific fields were specified, select all fields if the query is distinct (as App Engine only supports
             # distinct on projection queries) or the ones specified by only_load
-            self.queried_fields = [x.column for x in opts.fields if (x.column in only_load) or self.distinct]
+            self.queried_fields = [x.column for x in opts.fields if (x.column in only_load) or query.distinct]
 
-        self.keys_only = keys_only or self.queried_fields == [opts.pk.column]
+        self.keys_only = keys_only or self.queried_fields == [pk_col]
 
         # Projection queries don't return results unless all projected fields are
         # indexed on the model. This means if you add a field, and all fields on the model
@@ -582,23 +865,15 @@ class SelectCommand(object):
             # and not an only/defer, so get all the fields
             self.queried_fields = [ x.column for x in opts.fields ]
 
-        self.excluded_pks = set()
-
-        self.has_inequality_filter = False
-        self.all_filters = []
-        self.results = None
-
-        self.gae_query = None
-
         projection_fields = []
 
         if try_projection:
             for field in self.queried_fields:
                 # We don't include the primary key in projection queries...
-                if field == self.pk_col:
+                if field == pk_col:
                     order_fields = set([ x.strip("-") for x in self.ordering])
 
-                    if self.pk_col in order_fields or "pk" in order_fields:
+                    if pk_col in order_fields or "pk" in order_fields:
                         # If we were ordering on __key__ we can't do a projection at all
                         self.projection_fields = []
                         break
@@ -606,7 +881,7 @@ class SelectCommand(object):
 
                 # Text and byte fields aren't indexed, so we can't do a
                 # projection query
-                f = get_field_from_column(self.model, field)
+                f = get_field_from_column(model, field)
                 if not f:
                     raise CouldBeSupportedError("Attempting a cross-table select or dates query, or something?!")
                 assert f  # If this happens, we have a cross-table select going on! #FIXME
@@ -622,10 +897,7 @@ class SelectCommand(object):
         if opts.parents:
             self.projection = None
 
-        if isinstance(query.where, EmptyWhere):
-            # Empty where means return nothing!
-            raise EmptyResultSet()
-        else:
+        if not isinstance(query.where, EmptyWhere):
             try:
                 where_tables = _get_tables_from_where(query.where)
             except TypeError:
@@ -639,6 +911,165 @@ class SelectCommand(object):
                 self.unsupported_query_message = "Cross-join WHERE constraints aren't supported: %s" % _cols_from_where_node(query.where)
                 return
 
+    def apply(self, command):
+        command.unsupported_query_message = self.unsupported_query_message
+        command.ordering = list(self.ordering)
+        command.queried_fields = list(self.queried_fields)
+        command.keys_only = self.keys_only
+        command.projection = list(self.projection) if self.projection else None
+        command.distinct_on_field = self.distinct_on_field
+
+        if self.distinct_lookup_type:
+            lookup_type = self.distinct_lookup_type
+            command.distinct_field_convertor = lambda value: DATE_TRANSFORMS[lookup_type](command.connection, value)
+
+
+def get_query_plan(connection, query, keys_only=False):
+    """
+        Returns the QueryPlan for the query, reusing a previously built plan
+        for a query of the same shape if possible.
+    """
+    key = _query_plan_key(connection, query, keys_only)
+    if key is None:
+        return QueryPlan(connection, query, keys_only)
+
+    plan = _query_plan_cache.get(key)
+    if plan is None:
+        if len(_query_plan_cache) >= MAX_QUERY_PLAN_CACHE_SIZE:
+            _query_plan_cache.clear()
+
+        plan = QueryPlan(connection, query, keys_only)
+        _query_plan_cache[key] = plan
+
+    return plan
+
+
+class DistinctValues(object):
+    """
+        Keeps track of the values returned by a distinct query. If the results are ordered
+        by the distinct value then duplicates are always adjacent and only the last value
+        needs to be kept. Otherwise the most recently seen values are kept, up to a limit,
+        so that iterating huge querysets doesn't use unbounded memory.
+    """
+
+    def __init__(self, ordered, max_size=MAX_DISTINCT_VALUES):
+        self.ordered = ordered
+        self.max_size = max_size
+        self.last_value = object()
+        self.values = OrderedDict()
+
+    def add(self, value):
+        """ Returns True if the value hasn't been seen before """
+        if self.ordered:
+            if value == self.last_value:
+                return False
+            self.last_value = value
+            return True
+
+        if value in self.values:
+            return False
+
+        self.values[value] = None
+        if len(self.values) > self.max_size:
+            log_once(
+                DJANGAE_LOG.warning,
+                "Distinct query returned more than %s values without being ordered by them, duplicates may be returned", (self.max_size,)
+            )
+            self.values.popitem(last=False)
+        return True
+
+
+def keys_then_get_enabled(model):
+    """
+        Returns True if full entity queries on the model should be run as a keys_only
+        query followed by a Get, so that entities can be read from the cache
+    """
+    opts = getattr(model, "Djangae", None)
+    if opts and hasattr(opts, "keys_then_get"):
+        return bool(opts.keys_then_get)
+
+    return getattr(settings, "DJANGAE_KEYS_THEN_GET", False)
+
+
+def query_cache_enabled(model):
+    """
+        Returns True if the keys of the results of (sliced) queries on the model should be cached
+        in memcache until the next write to the model
+    """
+    opts = getattr(model, "Djangae", None)
+    if opts and hasattr(opts, "cache_queries"):
+        return bool(opts.cache_queries)
+
+    return getattr(settings, "DJANGAE_CACHE_QUERIES", False)
+
+
+def _invalidate_cached_queries(model):
+    if query_cache_enabled(model):
+        caching.invalidate_queries(get_top_concrete_parent(model)._meta.db_table)
+
+
+def bulk_updates_enabled(model):
+    """
+        Returns True if updates to the model should skip the per-entity transactions and just
+        Get and Put the entities in batches. This is only allowed if constraint checks are disabled.
+    """
+    if constraints.constraint_checks_enabled(model):
+        return False
+
+    opts = getattr(model, "Djangae", None)
+    if opts and hasattr(opts, "bulk_updates"):
+        return bool(opts.bulk_updates)
+
+    return getattr(settings, "DJANGAE_BULK_UPDATES", False)
+
+
+class SelectCommand(object):
+    def __init__(self, connection, query, keys_only=False):
+        self.where = None
+        self._column_converters = None
+        self._foreign_key_columns = None
+
+        self.original_query = query
+        self.connection = connection
+
+        self.limits = (query.low_mark, query.high_mark)
+        self.results_returned = 0
+
+        opts = query.get_meta()
+
+        self.distinct = query.distinct
+        self.distinct_values = None
+        self.distinct_on_field = None
+        self.distinct_field_convertor = None
+        self.queried_fields = []
+        self.model = query.model
+        self.pk_col = opts.pk.column
+        self.is_count = query.aggregates
+        self.extra_select = query.extra_select
+        self._set_db_table()
+
+        self.excluded_pks = set()
+
+        self.has_inequality_filter = False
+        self.all_filters = []
+        self.results = None
+
+        self.gae_query = None
+
+        try:
+            self._validate_query_is_possible(query)
+        except NotSupportedError as e:
+            self.unsupported_query_message = str(e)
+            return
+
+        get_query_plan(connection, query, keys_only).apply(self)
+        if self.unsupported_query_message:
+            return
+
+        if isinstance(query.where, EmptyWhere):
+            # Empty where means return nothing!
+            raise EmptyResultSet()
+        else:
             from dnf import parse_dnf
             try:
                 self.where, columns, self.excluded_pks = parse_dnf(query.where, self.connection, ordering=self.ordering)
@@ -660,6 +1091,20 @@ class SelectCommand(object):
         except ValueError:
             pass
 
+    @property
+    def column_converters(self):
+        """
+            A list of (column, converter) for the queried fields, where each converter
+            turns a datastore value into the value Django expects. These are built once
+            so that converting each row doesn't need to inspect the fields.
+        """
+        if self._column_converters is None:
+            self._column_converters = [
+                (col, None if col == "__key__" else self.connection.ops.get_value_converter(get_field_from_column(self.model, col)))
+                for col in self.queried_fields
+            ]
+        return self._column_converters
+
     def execute(self):
         if self.unsupported_query_message:
             raise NotSupportedError(self.unsupported_query_message)
@@ -849,7 +1294,7 @@ class SelectCommand(object):
 
                         new_queries.append(qry)
 
-                    query = datastore.MultiQuery(new_queries, ordering)
+                    query = AsyncMultiQuery(new_queries, ordering)
                 else:
                     query = queries[0]
                     try:
@@ -900,9 +1345,20 @@ class SelectCommand(object):
         self.query_done = True
 
     def _run_query(self, limit=None, start=None, aggregate_type=None):
-        if aggregate_type is None:
-            results = self.gae_query.Run(limit=limit, offset=start)
-            if self.keys_only:
+        if aggregate_type is None and self._can_use_query_cache(limit):
+            results = self._run_from_query_cache(limit, start)
+        elif aggregate_type is None:
+            keys_then_get = self._can_use_keys_then_get()
+            query = self._keys_only_query() if keys_then_get else self.gae_query
+
+            if self._can_use_query_cursors():
+                results = self._run_from_nearest_cursor(query, limit, start or 0)
+            else:
+                results = query.Run(limit=limit, offset=start)
+
+            if keys_then_get:
+                results = self._get_entities_for_keys(results)
+            elif self.keys_only:
                 # If we did a keys_only query for performance, we need to wrap the result
                 results = convert_keys_to_entities(results)
 
@@ -919,6 +1375,130 @@ class SelectCommand(object):
                     yield result
         return lazy_results()
 
+    def _can_use_query_cursors(self):
+        # Only plain datastore queries have cursors, the others run several queries or none at all
+        return (
+            caching.QUERY_CURSORS_ENABLED and
+            type(self.gae_query) is Query and
+            not self.distinct
+        )
+
+    def _can_use_query_cache(self, limit):
+        # Only small slices are cached, there's a limit on the size of a memcache value
+        opts = self.gae_query._Query__query_options
+        return (
+            query_cache_enabled(self.model) and
+            not datastore.IsInTransaction() and
+            type(self.gae_query) is Query and
+            not opts.projection and
+            not self.distinct and
+            limit is not None and
+            limit <= caching.QUERY_CACHE_MAX_RESULTS
+        )
+
+    def _run_from_query_cache(self, limit, start):
+        """
+            The keys of the results are cached in memcache until the next write to the model, so
+            identical queries only have to be run once. The entities are then read through the
+            cache a batch at a time, in the same way as keys_then_get.
+        """
+        keys, generation = caching.get_query_results(self.gae_query, limit, start)
+        if keys is None:
+            keys = list(self._keys_only_query().Run(limit=limit, offset=start))
+            caching.store_query_results(self.gae_query, limit, start, generation, keys)
+
+        if self.keys_only:
+            return convert_keys_to_entities(keys)
+
+        return self._get_entities_for_keys(keys)
+
+    def _can_use_keys_then_get(self):
+        opts = self.gae_query._Query__query_options
+        return (
+            keys_then_get_enabled(self.model) and
+            type(self.gae_query) is Query and
+            not opts.keys_only and
+            not opts.projection
+        )
+
+    def _keys_only_query(self):
+        keys_query = Query(self.gae_query._Query__kind, keys_only=True)
+        keys_query.update(self.gae_query)
+        keys_query.Order(*self.gae_query._Query__orderings)
+        return keys_query
+
+    def _get_entities_for_keys(self, keys):
+        """
+            Turns the results of a keys_only query back into entities, a batch at a time. Each
+            batch is read from the context cache and memcache where possible, and the
+            misses are fetched with a single Get. Because the results of the query are
+            eventually consistent, and the cache may be stale, each entity is checked to
+            make sure it still matches the query.
+        """
+        matcher = utils.compile_query_matcher(self.gae_query)
+
+        keys = iter(keys)
+        while True:
+            batch = list(islice(keys, KEYS_THEN_GET_BATCH_SIZE))
+            if not batch:
+                break
+
+            entities = caching.get_from_cache_by_keys(batch)
+            missing = [ x for x in batch if x not in entities ]
+            if missing:
+                fetched = [ x for x in datastore.Get(missing) if x is not None ]
+                caching.add_entities_to_cache(self.model, fetched, caching.CachingSituation.DATASTORE_GET)
+                entities.update((x.key(), x) for x in fetched)
+
+            for key in batch:
+                entity = entities.get(key)
+                if entity is not None and matcher(entity):
+                    yield entity
+
+    def _run_from_nearest_cursor(self, query, limit, start):
+        """
+            The datastore reads (and bills) every entity skipped by an offset, so rather
+            than running with the full offset we start from the nearest cursor we've
+            previously stored for this query, and store the cursor at the end of the results
+            so that fetching the next slice doesn't need an offset at all.
+        """
+        position, cursor = caching.get_nearest_query_cursor(query, start)
+        if cursor:
+            results = query.Run(limit=limit, offset=start - position, start_cursor=cursor)
+        else:
+            results = query.Run(limit=limit, offset=start)
+
+        def store_cursor(count):
+            # The query must have finished, otherwise the cursor could be for wherever it had got
+            # to in the current batch rather than for the end of the results
+            caching.store_query_cursor(query, start + count, query.GetCursor())
+
+        def results_with_cursors():
+            count = 0
+            iterator = iter(results)
+            for result in iterator:
+                count += 1
+                if count == limit:
+                    # The consumer might stop as soon as it has enough results, so finish the
+                    # query and store the cursor before yielding the last one. Nothing is left
+                    # after the limit, so this doesn't fetch another batch
+                    for extra in iterator:
+                        pass
+
+                    store_cursor(count)
+
+                yield result
+
+            if count and count != limit:
+                store_cursor(count)
+
+        return results_with_cursors()
+
+    def _ordered_by(self, column):
+        """ Returns True if the results are ordered by column before anything else """
+        if not self.ordering or not isinstance(self.ordering[0], basestring):
+            return False
+        return self.ordering[0].lstrip("-") == column
 
     def next_result(self):
         if self.limits[1]:
@@ -938,52 +1518,392 @@ class SelectCommand(object):
                 value = x[self.distinct_on_field]
                 value = self.distinct_field_convertor(value)
 
-                if value in self.distinct_values:
+                if self.distinct_values is None:
+                    self.distinct_values = DistinctValues(self._ordered_by(self.distinct_on_field))
+
+                if not self.distinct_values.add(value):
                     continue
                 else:
-                    self.distinct_values.add(value)
                     # Insert modified value into entity before returning the entity. This is dirty,
                     # but Cursor.fetchone (which calls this) wants the entity ID and yet also wants
                     # the correct value for this field. The alternative would be to call
                     # self.distinct_field_convertor again in Cursor.fetchone, but that's wasteful.
                     x[self.distinct_on_field] = value
 
+            if not isinstance(x, datastore.Key):
+                if caching.AUTO_BATCH_GETS:
+                    self._add_pending_gets(x)
+
             self.results_returned += 1
             return x
 
+    def _add_pending_gets(self, entity):
+        """
+            Tell the cache about the entities the foreign keys of this one point to, so that
+            accessing them on each of the results doesn't cost a Get each
+        """
+        if self._foreign_key_columns is None:
+            # A foreign key with a to_field holds that field's value, which isn't the key of anything
+            self._foreign_key_columns = [
+                (x.column, x.rel.to) for x in self.model._meta.fields
+                if isinstance(x, ForeignKey) and x.rel.field_name == x.rel.to._meta.pk.name
+            ]
+
+        caching.add_pending_gets([
+            get_datastore_key(model, entity[column])
+            for column, model in self._foreign_key_columns if entity.get(column) is not None
+        ])
+
 class FlushCommand(object):
     """
         sql_flush returns the SQL statements to flush the database,
         which are then executed by cursor.execute()
 
-        We instead return a list of FlushCommands which are called by
-        our cursor.execute
+        We instead return a single FlushCommand for all of the tables
+        which is called by our cursor.execute
     """
-    def __init__(self, table):
-        self.table = table
+    def __init__(self, tables):
+        if isinstance(tables, basestring):
+            tables = [tables]
 
-    def execute(self):
-        table = self.table
-        query = datastore.Query(table, keys_only=True)
-        while query.Count():
-            datastore.Delete(query.Run())
+        self.tables = tables
 
-        # Delete the markers we need to
+    def _queries(self):
         from djangae.db.constraints import UniqueMarker
-        query = datastore.Query(UniqueMarker.kind(), keys_only=True)
-        query["__key__ >="] = datastore.Key.from_path(UniqueMarker.kind(), self.table)
-        query["__key__ <"] = datastore.Key.from_path(UniqueMarker.kind(), u"{}{}".format(self.table, u'\ufffd'))
-        while query.Count():
-            datastore.Delete(query.Run())
+
+        for table in self.tables:
+            yield datastore.Query(table, keys_only=True)
+
+            # Delete the markers we need to
+            query = datastore.Query(UniqueMarker.kind(), keys_only=True)
+            query["__key__ >="] = datastore.Key.from_path(UniqueMarker.kind(), table)
+            query["__key__ <"] = datastore.Key.from_path(UniqueMarker.kind(), u"{}{}".format(table, u'\ufffd'))
+            yield query
+
+    def _delete_all(self, queries):
+        """
+            Deletes every key returned by the queries, returning the number of keys deleted. All the
+            queries are started at once and page through their results with cursors, and the keys
+            are deleted in batches with several Delete RPCs running at a time.
+        """
+        keys = chain.from_iterable([ x.Run(batch_size=FLUSH_BATCH_SIZE) for x in queries ])
+
+        deleted = 0
+        in_flight = deque()
+        while True:
+            batch = list(islice(keys, FLUSH_BATCH_SIZE))
+            if not batch:
+                break
+
+            if len(in_flight) == FLUSH_MAX_IN_FLIGHT:
+                in_flight.popleft().get_result()
+
+            in_flight.append(datastore.DeleteAsync(batch))
+            deleted += len(batch)
+
+        for rpc in in_flight:
+            rpc.get_result()
+
+        return deleted
+
+    def execute(self):
+        flush_write_batch()
+
+        queries = list(self._queries())
+
+        # Keep going until a pass finds nothing, in case the queries didn't see everything
+        while self._delete_all(queries):
+            pass
 
         cache.clear()
         clear_context_cache()
 
+
+_pending_futures = threading.local()
+
+
+class Future(object):
+    """
+        The result of an asynchronous write. The RPCs are already running when the Future is
+        created, get_result() waits for them and then does whatever the synchronous write would
+        have done afterwards (e.g. updating the cache) before returning the same result, or
+        raising the same exception.
+    """
+    def __init__(self, callback):
+        self._callback = callback
+        self._done = False
+        self._result = None
+        self._exc_info = None
+
+        if not hasattr(_pending_futures, "futures"):
+            _pending_futures.futures = []
+        _pending_futures.futures.append(self)
+
+    @classmethod
+    def completed(cls, result):
+        """
+            Returns a Future for something which has already been done synchronously
+        """
+        future = cls(None)
+        future._set_result(result)
+        return future
+
+    def _set_result(self, result):
+        self._done = True
+        self._result = result
+        _pending_futures.futures.remove(self)
+
+    def done(self):
+        return self._done
+
+    def get_result(self):
+        if not self._done:
+            try:
+                self._set_result(self._callback())
+            except:
+                self._exc_info = sys.exc_info()
+                self._set_result(None)
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+
+@receiver(request_finished)
+def wait_all(*args, **kwargs):
+    """
+        Waits for any Futures which haven't been resolved yet, so that their cache and
+        unique marker updates aren't lost. Errors are logged rather than raised.
+    """
+    for future in list(getattr(_pending_futures, "futures", [])):
+        try:
+            future.get_result()
+        except Exception:
+            DJANGAE_LOG.exception("Unhandled error in an asynchronous write")
+
+
+_write_batches = threading.local()
+
+
+class WriteBatch(object):
+    """
+        The entities whose Puts have been queued inside batch_writes(). Until they are Put the
+        entities are only in the context cache, so they can still be read back by key.
+    """
+    def __init__(self):
+        self.ids = {}
+        self._reset()
+
+    def _reset(self):
+        self.entities = OrderedDict()  # key -> (model, entity)
+        self.originals = {}  # key -> (model, entity) as it was in the datastore before being updated
+        self.unsaved = set()  # Keys of the queued inserts
+        self.markers = {}  # key -> unique markers acquired for the queued entity
+        self.identifiers_to_release = {}  # key -> identifiers to release once the entity is Put
+
+    def _allocate_id(self, key):
+        ids = self.ids.get(key.kind())
+        if not ids:
+            template = datastore.Key.from_path(key.kind(), 1, namespace=key.namespace())
+            start, end = datastore.AllocateIds(template, size=WRITE_BATCH_ID_BLOCK_SIZE)
+            ids = self.ids[key.kind()] = deque(xrange(start, end + 1))
+
+        return ids.popleft()
+
+    def complete_key(self, entity):
+        """
+            Returns the entity with an allocated id if its key is incomplete, so that
+            we can return the id before the entity is Put()
+        """
+        key = entity.key()
+        if key.has_id_or_name():
+            return entity
+
+        completed = datastore.Entity(
+            key.kind(), id=self._allocate_id(key), namespace=key.namespace(),
+            unindexed_properties=entity.unindexed_properties()
+        )
+        completed.update(entity)
+        return completed
+
+    def update_markers(self, key, to_acquire, to_release):
+        """
+            Acquires the new unique markers of a queued update, the old ones are released once
+            it has been Put(). Markers for an entity which hasn't been Put() yet don't point at it.
+        """
+        markers = constraints.acquire_identifiers(to_acquire, key, unsaved=key in self.unsaved)
+        self.markers.setdefault(key, []).extend(markers)
+
+        released = self.identifiers_to_release.setdefault(key, set())
+        released.difference_update(to_acquire)
+        released.update(to_release)
+
+    def queue(self, model, entities, markers=(), unsaved=False):
+        """
+            Queues the Puts of the entities. markers are the unique markers acquired for each
+            entity, they are released if the entity is never Put.
+        """
+        for entity, acquired in izip_longest(entities, markers, fillvalue=()):
+            key = entity.key()
+            self.entities[key] = (model, entity)
+            self.markers.setdefault(key, []).extend(acquired)
+            if unsaved:
+                self.unsaved.add(key)
+
+        caching.add_entities_to_context(model, entities)
+
+    @db.non_transactional
+    def flush(self):
+        # Take everything off the batch first, anything queued from here on is in the next flush
+        pending = copy.copy(self)
+        self._reset()
+
+        keys = pending.entities.keys()
+        done = 0
+        try:
+            for i in xrange(0, len(keys), WRITE_BATCH_PUT_SIZE):
+                chunk = keys[i:i + WRITE_BATCH_PUT_SIZE]
+                datastore.Put([ pending.entities[x][1] for x in chunk ])
+                done += len(chunk)
+        except:
+            pending._abandon(keys[done:])
+            raise
+        finally:
+            # Any chunks which were Put need the same treatment as a successful flush
+            pending._finish(keys[:done])
+
+    def discard(self):
+        """
+            Forgets the queued Puts without making them, releasing any markers acquired for them
+        """
+        pending = copy.copy(self)
+        self._reset()
+        pending._abandon(pending.entities.keys())
+
+    def _by_model(self, pairs):
+        ret = OrderedDict()
+        for model, entity in pairs:
+            ret.setdefault(model, []).append(entity)
+        return ret.items()
+
+    def _finish(self, keys):
+        if not keys:
+            return
+
+        to_release = set(chain.from_iterable(self.identifiers_to_release.get(x, ()) for x in keys))
+        if to_release:
+            constraints.release_identifiers(list(to_release))
+
+        # Now that the inserted entities exist, their markers can point at them
+        for key in keys:
+            if key in self.unsaved:
+                markers = [ x for x in self.markers.get(key, []) if x.key().name() not in to_release ]
+                constraints.update_instance_on_markers(self.entities[key][1], markers)
+
+        # Wipe any cached versions of the updated entities, then cache everything we Put()
+        for model, group in self._by_model(self.originals[x] for x in keys if x in self.originals):
+            caching.remove_entities_from_cache(model, group)
+
+        for model, group in self._by_model(self.entities[x] for x in keys):
+            caching.add_entities_to_cache(model, group, caching.CachingSituation.DATASTORE_PUT)
+            _invalidate_cached_queries(model)
+
+    def _abandon(self, keys):
+        if not keys:
+            return
+
+        to_release = []
+        for key in keys:
+            markers = self.markers.get(key, [])
+            if key in self.originals:
+                # The entity still holds the markers it had in the datastore
+                model, original = self.originals[key]
+                held = set(unique_identifiers_from_entity(model, original, ignore_pk=True))
+                markers = [ x for x in markers if x.key().name() not in held ]
+            to_release.extend(markers)
+
+        if to_release:
+            constraints.release_markers(to_release)
+
+        # The queued entities were only ever in the context cache
+        for model, group in self._by_model(self.entities[x] for x in keys):
+            caching.remove_entities_from_cache(model, group)
+
+
+def start_write_batch():
+    """
+        Starts queuing Puts on this thread, returns False if they were already being queued
+    """
+    if getattr(_write_batches, "batch", None):
+        return False
+
+    _write_batches.batch = WriteBatch()
+    return True
+
+
+def finish_write_batch():
+    """
+        Makes all the queued Puts and stops queuing them
+    """
+    batch, _write_batches.batch = _write_batches.batch, None
+    batch.flush()
+
+
+def discard_write_batch():
+    """
+        Forgets the queued Puts without making them and stops queuing them
+    """
+    batch, _write_batches.batch = _write_batches.batch, None
+    batch.discard()
+
+
+def flush_write_batch():
+    """
+        Makes the queued Puts straight away, if there are any
+    """
+    batch = getattr(_write_batches, "batch", None)
+    if batch:
+        batch.flush()
+
+
+def _get_queued_entities(keys):
+    """
+        Returns a dictionary of key -> entity for any of the keys whose Puts are queued, so
+        that they can be read back even if the context cache is disabled
+    """
+    batch = getattr(_write_batches, "batch", None)
+    if not batch:
+        return {}
+
+    return { x: copy.deepcopy(batch.entities[x][1]) for x in keys if x in batch.entities }
+
+
+def _active_write_batch():
+    """
+        Returns the WriteBatch to queue Puts on, or None if they should be made straight away.
+        Transactions can't see the queued entities, so inside one they are all Put() first.
+    """
+    batch = getattr(_write_batches, "batch", None)
+    if batch and datastore.IsInTransaction():
+        batch.flush()
+        return None
+
+    return batch
+
+
 @db.non_transactional
 def reserve_id(kind, id_or_name):
+    reserve_ids([datastore.Key.from_path(kind, id_or_name)])
+
+
+@db.non_transactional
+def reserve_ids(keys):
     from google.appengine.api.datastore import _GetConnection
-    key = datastore.Key.from_path(kind, id_or_name)
-    _GetConnection()._async_reserve_keys(None, [key])
+
+    keys = [ x for x in keys if x is not None ]
+    if keys:
+        _GetConnection()._async_reserve_keys(None, keys).get_result()
 
 
 class InsertCommand(object):
@@ -1009,77 +1929,190 @@ class InsertCommand(object):
                 django_instance_to_entity(connection, model, fields, raw, obj)
             )
 
+    def _check_keys(self):
+        seen = set()
+        for key in self.included_keys:
+            id_or_name = key.id_or_name()
+            if isinstance(id_or_name, basestring) and id_or_name.startswith("__"):
+                raise NotSupportedError("Datastore ids cannot start with __. Id was %s" % id_or_name)
+
+            if key in seen:
+                raise IntegrityError("Tried to INSERT the same key more than once")
+            seen.add(key)
+
+    def _insert_with_keys_in_transaction(self):
+        # We're already in a transaction, so we can't start our own. Just check all the keys with a
+        # single Get and then Put() everything at once
+        if any(x is not None for x in datastore.Get(self.included_keys)):
+            raise IntegrityError("Tried to INSERT with existing key")
+
+        markers = []
+        if constraints.constraint_checks_enabled(self.model):
+            markers = constraints.acquire_bulk(self.model, self.entities)
+
+        try:
+            results = datastore.Put(self.entities)
+        except:
+            constraints.release_markers(chain(*markers))
+            raise
+
+        reserve_ids(self.included_keys)
+
+        # This also clears any tombstones for the keys, even if there are no markers
+        caching.add_entities_to_cache(self.model, self.entities, caching.CachingSituation.DATASTORE_PUT)
+        return results
+
+    def _insert_with_keys(self):
+        """
+            Rather than checking for existence and inserting each entity in its own transaction, the
+            entities are split into cross-group transactions of up to MAX_ENTITY_GROUPS_PER_TRANSACTION
+            entities, which all run concurrently. The existence of every key is checked before anything
+            is Put(), so if any of the keys already exist nothing is inserted.
+        """
+        from google.appengine.api.datastore import _GetConnection
+
+        size = MAX_ENTITY_GROUPS_PER_TRANSACTION
+        chunks = [ self.entities[i:i + size] for i in xrange(0, len(self.entities), size) ]
+
+        connection = _GetConnection()
+        transactions = [ connection.new_transaction(TransactionOptions(xg=True)) for chunk in chunks ]
+
+        def rollback():
+            for rpc in [ x.async_rollback(None) for x in transactions ]:
+                try:
+                    rpc.get_result()
+                except datastore_errors.Error:
+                    DJANGAE_LOG.exception("Error rolling back insert transaction")
+
+        markers = []
+        try:
+            gets = [ txn.async_get(None, [ x.key() for x in chunk ]) for txn, chunk in zip(transactions, chunks) ]
+            if any(x is not None for rpc in gets for x in rpc.get_result()):
+                raise IntegrityError("Tried to INSERT with existing key")
+
+            if constraints.constraint_checks_enabled(self.model):
+                markers = constraints.acquire_bulk(self.model, self.entities)
+
+            puts = [ txn.async_put(None, chunk) for txn, chunk in zip(transactions, chunks) ]
+            results = list(chain.from_iterable(rpc.get_result() for rpc in puts))
+        except:
+            rollback()
+            constraints.release_markers(chain(*markers))
+            raise
+
+        commits = [ txn.async_commit(None) for txn in transactions ]
+
+        failed = []
+        for i, rpc in enumerate(commits):
+            try:
+                if not rpc.get_result():
+                    failed.append(i)
+            except datastore_errors.Error:
+                DJANGAE_LOG.exception("Error committing insert transaction")
+                failed.append(i)
+
+        if failed:
+            if markers:
+                markers_by_chunk = [ markers[i:i + size] for i in xrange(0, len(markers), size) ]
+                constraints.release_markers(chain.from_iterable(chain(*markers_by_chunk[i]) for i in failed))
+
+            # The other chunks were inserted, so they need the same treatment as a successful insert
+            committed = [ x for i, chunk in enumerate(chunks) if i not in failed for x in chunk ]
+            if committed:
+                reserve_ids([ x.key() for x in committed ])
+                caching.add_entities_to_cache(self.model, committed, caching.CachingSituation.DATASTORE_PUT)
+                _invalidate_cached_queries(self.model)
+
+            raise datastore_errors.TransactionFailedError(
+                "Unable to insert {} of {} entities".format(sum(len(chunks[i]) for i in failed), len(self.entities))
+            )
+
+        # Make sure we notify app engine that we are using these IDs
+        # FIXME: Copy ancestor across to the template key
+        reserve_ids(self.included_keys)
+
+        # This also clears any tombstones for the keys, even if there are no markers
+        caching.add_entities_to_cache(self.model, self.entities, caching.CachingSituation.DATASTORE_PUT)
+
+        return results
+
+    def _queue_inserts(self, batch):
+        self.entities = [ batch.complete_key(x) for x in self.entities ]
+
+        # Acquire the markers now, so that any IntegrityError is raised by the save(). They don't
+        # point at the entities until they've been Put, otherwise they could be stolen meanwhile
+        markers = []
+        if constraints.constraint_checks_enabled(self.model):
+            markers = constraints.acquire_bulk(self.model, self.entities, unsaved=True)
+
+        batch.queue(self.model, self.entities, markers=markers, unsaved=True)
+        return [ x.key() for x in self.entities ]
+
     def execute(self):
+        batch = _active_write_batch()
+
         if self.has_pk and not has_concrete_parents(self.model):
-            results = []
             # We are inserting, but we specified an ID, we need to check for existence before we Put()
-            # We do it in a loop so each check/put is transactional - because it's an ancestor query it shouldn't
-            # cost any entity groups
+            self._check_keys()
 
-            was_in_transaction = datastore.IsInTransaction()
+            if batch and any(x in batch.entities for x in self.included_keys):
+                raise IntegrityError("Tried to INSERT with existing key")
 
-            for key, ent in zip(self.included_keys, self.entities):
-                @db.transactional
-                def txn():
-                    if key is not None:
-                        if utils.key_exists(key):
-                            raise IntegrityError("Tried to INSERT with existing key")
+            if datastore.IsInTransaction():
+                results = self._insert_with_keys_in_transaction()
+            else:
+                results = self._insert_with_keys()
 
-                    id_or_name = key.id_or_name()
-                    if isinstance(id_or_name, basestring) and id_or_name.startswith("__"):
-                        raise NotSupportedError("Datastore ids cannot start with __. Id was %s" % id_or_name)
+            _invalidate_cached_queries(self.model)
+            return results
+        elif batch:
+            return self._queue_inserts(batch)
+        else:
+            return self._insert_async().get_result()
 
-                    if not constraints.constraint_checks_enabled(self.model):
-                        # Fast path, just insert
-                        results.append(datastore.Put(ent))
-                    else:
-                        markers = constraints.acquire(self.model, ent)
-                        try:
-                            results.append(datastore.Put(ent))
-                            if not was_in_transaction:
-                                # We can cache if we weren't in a transaction before this little nested one
-                                caching.add_entity_to_cache(self.model, ent, caching.CachingSituation.DATASTORE_GET_PUT)
-                        except:
-                            # Make sure we delete any created markers before we re-raise
-                            constraints.release_markers(markers)
-                            raise
+    def _insert_async(self):
+        markers = []
+        if constraints.constraint_checks_enabled(self.model):
+            #FIXME: We should rearrange this so that each entity is handled individually. We'll
+            # lose insert performance, but gain consistency on errors which is more important
+            markers = constraints.acquire_bulk(self.model, self.entities)
 
-                # Make sure we notify app engine that we are using this ID
-                # FIXME: Copy ancestor across to the template key
-                reserve_id(key.kind(), key.id_or_name())
+        try:
+            rpc = datastore.PutAsync(self.entities)
+        except:
+            constraints.release_markers(chain(*markers))
+            raise
 
-                txn()
+        def callback():
+            try:
+                results = rpc.get_result()
+                caching.add_entities_to_cache(self.model, self.entities, caching.CachingSituation.DATASTORE_PUT)
+            except:
+                constraints.release_markers(chain(*markers))
+                raise
 
-            return results
-        else:
+            _invalidate_cached_queries(self.model)
 
-            if not constraints.constraint_checks_enabled(self.model):
-                # Fast path, just bulk insert
-                results = datastore.Put(self.entities)
-                for entity in self.entities:
-                    caching.add_entity_to_cache(self.model, entity, caching.CachingSituation.DATASTORE_PUT)
-                return results
-            else:
-                markers = []
-                try:
-                    #FIXME: We should rearrange this so that each entity is handled individually like above. We'll
-                    # lose insert performance, but gain consistency on errors which is more important
-                    markers = constraints.acquire_bulk(self.model, self.entities)
+            for ent, m in zip(self.entities, markers):
+                constraints.update_instance_on_markers(ent, m)
 
-                    results = datastore.Put(self.entities)
-                    for entity in self.entities:
-                        caching.add_entity_to_cache(self.model, entity, caching.CachingSituation.DATASTORE_PUT)
+            return results
 
-                except:
-                    to_delete = chain(*markers)
-                    constraints.release_markers(to_delete)
-                    raise
+        return Future(callback)
 
-                for ent, k, m in zip(self.entities, results, markers):
-                    ent.__key = k
-                    constraints.update_instance_on_markers(ent, m)
+    def execute_async(self):
+        """
+            Like execute() but returns a Future which resolves to the inserted keys. Unique markers
+            are acquired before this returns, so IntegrityErrors are raised here rather than by
+            get_result(). Inserts with a primary key need the existence of their keys checking before
+            the Put(), and writes inside a transaction have to finish before it commits, so those
+            happen synchronously, as do inserts inside batch_writes() which are just queued.
+        """
+        if (datastore.IsInTransaction() or _active_write_batch() or
+                (self.has_pk and not has_concrete_parents(self.model))):
+            return Future.completed(self.execute())
 
-                return results
+        return self._insert_async()
 
     def lower(self):
         """
@@ -1092,31 +2125,100 @@ class DeleteCommand(object):
     def __init__(self, connection, query):
         self.select = SelectCommand(connection, query, keys_only=True)
 
-    def execute(self):
-        self.select.execute()
+    def _delete_keys(self, keys):
+        """
+            If the only unique field is the primary key, then everything we need to remove the
+            entities from the cache can be worked out from the keys so the entities are never read
+        """
+        # The identifiers are locked rather than deleted, so that nobody can cache what they
+        # read between now and the Delete finishing
+        self.locked.extend(caching.remove_entities_from_cache_by_keys(keys, lock=True))
+        return datastore.DeleteAsync(keys)
 
-        # This is a little bit more inefficient than just doing a keys_only query and
-        # sending it to delete, but I think this is the sacrifice to make for the unique caching layer
-        keys = []
+    def _delete_entities(self, keys):
+        """
+            The entities have to be read so that we can release their unique markers and remove
+            them from the cache using the values of their unique fields
+        """
+        model = self.select.model
 
         def spawn_query(kind, key):
             qry = Query(kind)
             qry["__key__ ="] = key
             return qry
 
-        queries = [spawn_query(self.select.db_table, x.key()) for x in self.select.results]
-        if not queries:
-            return
+        queries = [ spawn_query(self.select.db_table, x) for x in keys ]
+        entities = list(QueryByKeys(model, queries, []).Run())
+
+        # Delete constraints if that's enabled
+        if constraints.constraint_checks_enabled(model):
+            constraints.release_bulk(model, entities)
+
+        self.locked.extend(caching.remove_entities_from_cache(model, entities, lock=True))
+        return datastore.DeleteAsync([ x.key() for x in entities ])
+
+    def _delete_async(self):
+        # Make sure the deleted entities don't come back when the queued Puts are made
+        flush_write_batch()
+
+        self.select.execute()
+
+        if _unique_combinations(self.select.model, ignore_pk=True):
+            delete = self._delete_entities
+        else:
+            delete = self._delete_keys
+
+        self.locked = []
+        in_flight = deque()
+        keys = (x.key() for x in self.select.results)
+        try:
+            while True:
+                batch = list(islice(keys, DELETE_BATCH_SIZE))
+                if not batch:
+                    break
+
+                if len(in_flight) == DELETE_MAX_IN_FLIGHT:
+                    in_flight.popleft().get_result()
+
+                in_flight.append(delete(batch))
+        except:
+            exc_info = sys.exc_info()
+
+            # The Deletes which were started have to finish before the locks are released
+            for rpc in in_flight:
+                try:
+                    rpc.get_result()
+                except datastore_errors.Error:
+                    DJANGAE_LOG.exception("Error deleting entities")
+
+            caching.release_locks(self.locked)
+            _invalidate_cached_queries(self.select.model)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        def callback():
+            try:
+                for rpc in in_flight:
+                    rpc.get_result()
+            finally:
+                # Every Delete has finished, so nothing deleted can be read and cached anymore
+                caching.release_locks(self.locked)
+                _invalidate_cached_queries(self.select.model)
 
-        for entity in QueryByKeys(self.select.model, queries, []).Run():
-            keys.append(entity.key())
+        return Future(callback)
 
-            # Delete constraints if that's enabled
-            if constraints.constraint_checks_enabled(self.select.model):
-                constraints.release(self.select.model, entity)
+    def execute(self):
+        return self._delete_async().get_result()
+
+    def execute_async(self):
+        """
+            Like execute() but returns a Future. The entities are removed from the cache, and their
+            unique markers released, before this returns. Deletes inside a transaction have to finish
+            before it commits so they happen synchronously.
+        """
+        if datastore.IsInTransaction():
+            return Future.completed(self.execute())
 
-            caching.remove_entity_from_cache_by_key(entity.key())
-        datastore.Delete(keys)
+        return self._delete_async()
 
     def lower(self):
         """
@@ -1125,12 +2227,23 @@ class DeleteCommand(object):
         return str(self).lower()
 
 
+@memoized
+def _unique_columns(model):
+    """
+        Returns the columns which are part of a unique constraint, other than the primary key
+    """
+    return frozenset(
+        model._meta.get_field(x).column for combination in _unique_combinations(model, ignore_pk=True) for x in combination
+    )
+
+
 class UpdateCommand(object):
     def __init__(self, connection, query):
         self.model = query.model
         self.select = SelectCommand(connection, query, keys_only=True)
         self.values = query.values
         self.connection = connection
+        self._changes = None
 
     def lower(self):
         """
@@ -1138,6 +2251,66 @@ class UpdateCommand(object):
         """
         return str(self).lower()
 
+    @property
+    def changes(self):
+        """
+            The new values of the updated columns (including their special indexes) which are
+            worked out once and then applied to each of the entities
+        """
+        if self._changes is None:
+            instance_kwargs = {field.attname:value for field, param, value in self.values}
+
+            # Note: If you replace MockInstance with self.model, you'll find that some delete
+            # tests fail in the test app. This is because any unspecified fields would then call
+            # get_default (even though we aren't going to use them) which may run a query which
+            # fails inside a transaction. Given as we are just using MockInstance so that we can
+            # call django_instance_to_entity it on it with the subset of fields we pass in,
+            # what we have is fine.
+            instance = MockInstance(**instance_kwargs)
+
+            self._changes = dict(django_instance_to_entity(
+                self.connection, self.model,
+                [ x[0] for x in self.values],  # Pass in the fields that were updated
+                True, instance)
+            )
+        return self._changes
+
+    def _changed_columns(self, entity):
+        return [ k for k, v in self.changes.iteritems() if k not in entity or entity[k] != v ]
+
+    def _apply_values(self, entity):
+        """
+            Updates entity with the new values which differ from its current ones. Returns a
+            tuple of (copy of the entity as it was, changed columns)
+        """
+        changed = self._changed_columns(entity)
+        if not changed:
+            return entity, changed
+
+        original = copy.deepcopy(entity)
+        entity.update(copy.deepcopy({ x: self.changes[x] for x in changed }))
+        return original, changed
+
+    def _get_markers_for_update(self, original, result, changed):
+        # There's no need to work out the identifiers if none of the unique columns changed
+        if not _unique_columns(self.model).intersection(changed):
+            return set(), set()
+
+        return constraints.get_markers_for_update(self.model, original, result)
+
+    def _unchanged_keys_skipped(self, keys):
+        """
+            Yields the keys, except those whose entities were read or written during this request
+            and already have the new values, which are counted in self.unchanged instead
+        """
+        for key in keys:
+            snapshot = caching.get_snapshot(key)
+            if snapshot is not None and not self._changed_columns(snapshot):
+                self.unchanged += 1
+                continue
+
+            yield key
+
     @db.transactional
     def _update_entity(self, key):
         caching.remove_entity_from_cache_by_key(key)
@@ -1148,31 +2321,17 @@ class UpdateCommand(object):
             # Return false to indicate update failure
             return False
 
-        original = copy.deepcopy(result)
-
-        instance_kwargs = {field.attname:value for field, param, value in self.values}
-
-        # Note: If you replace MockInstance with self.model, you'll find that some delete
-        # tests fail in the test app. This is because any unspecified fields would then call
-        # get_default (even though we aren't going to use them) which may run a query which
-        # fails inside this transaction. Given as we are just using MockInstance so that we can
-        # call django_instance_to_entity it on it with the subset of fields we pass in,
-        # what we have is fine.
-        instance = MockInstance(**instance_kwargs)
-
-        # Update the entity we read above with the new values
-        result.update(django_instance_to_entity(
-            self.connection, self.model,
-            [ x[0] for x in self.values],  # Pass in the fields that were updated
-            True, instance)
-        )
+        original, changed = self._apply_values(result)
+        if not changed:
+            # Nothing to write, but the entity still counts as updated
+            return True
 
         if not constraints.constraint_checks_enabled(self.model):
             # The fast path, no constraint checking
             datastore.Put(result)
             caching.add_entity_to_cache(self.model, result, caching.CachingSituation.DATASTORE_PUT)
         else:
-            to_acquire, to_release = constraints.get_markers_for_update(self.model, original, result)
+            to_acquire, to_release = self._get_markers_for_update(original, result, changed)
 
             # Acquire first, because if that fails then we don't want to alter what's already there
             constraints.acquire_identifiers(to_acquire, result.key())
@@ -1189,15 +2348,243 @@ class UpdateCommand(object):
         # Return true to indicate update success
         return True
 
+    def _update_entities(self, keys):
+        """
+            Updates each of the keys in its own transaction, like _update_entity, but with all of
+            the transactions running concurrently. Errors are recorded in self.failures rather
+            than raised. Returns a tuple of (updated count, keys to retry) where the keys to retry
+            are those whose transactions failed to commit because of contention.
+        """
+        from google.appengine.api.datastore import _GetConnection
+
+        connection = _GetConnection()
+        check_constraints = constraints.constraint_checks_enabled(self.model)
+
+        transactions = [ connection.new_transaction(TransactionOptions()) for key in keys ]
+        gets = [ txn.async_get(None, [key]) for txn, key in zip(transactions, keys) ]
+
+        # Rollbacks are waited for at the end, there's nothing to do with their results
+        rollbacks = []
+
+        def rollback(txn):
+            rollbacks.append(txn.async_rollback(None))
+
+        puts = []
+        deleted = []
+        unchanged = 0
+        for txn, key, rpc in zip(transactions, keys, gets):
+            to_acquire = to_release = []
+            try:
+                result = rpc.get_result()[0]
+                if result is None:
+                    # The entity has been deleted since we queried for it
+                    rollback(txn)
+                    deleted.append(key)
+                    continue
+
+                original, changed = self._apply_values(result)
+                if not changed:
+                    rollback(txn)
+                    unchanged += 1
+                    continue
+
+                if check_constraints:
+                    to_acquire, to_release = self._get_markers_for_update(original, result, changed)
+                    constraints.acquire_identifiers(to_acquire, result.key())
+
+                puts.append((txn, key, original, result, to_acquire, to_release, txn.async_put(None, [result])))
+            except (IntegrityError, datastore_errors.Error) as e:
+                rollback(txn)
+                self.failures.append((key, e))
+
+        # Wipe the versions we read from the cache, the identifiers come from the entities so this
+        # is a single delete_many without reading memcache
+        caching.remove_entities_from_cache(self.model, [ x[2] for x in puts ])
+        if deleted and _unique_combinations(self.model, ignore_pk=True):
+            # The entities' other identifiers can only be found by reading what's in memcache
+            for key in deleted:
+                caching.remove_entity_from_cache_by_key(key)
+        elif deleted:
+            caching.remove_entities_from_cache_by_keys(deleted)
+
+        commits = []
+        for txn, key, original, result, to_acquire, to_release, rpc in puts:
+            try:
+                rpc.get_result()
+            except datastore_errors.Error as e:
+                rollback(txn)
+                constraints.release_identifiers(to_acquire)
+                self.failures.append((key, e))
+            else:
+                commits.append((key, result, to_acquire, to_release, txn.async_commit(None)))
+
+        updated = []
+        retry = []
+        for key, result, to_acquire, to_release, rpc in commits:
+            try:
+                committed = rpc.get_result()
+            except datastore_errors.TransactionFailedError:
+                committed = False
+            except datastore_errors.Error as e:
+                constraints.release_identifiers(to_acquire)
+                self.failures.append((key, e))
+                continue
+
+            if committed:
+                # Now we release the ones we don't want anymore
+                constraints.release_identifiers(to_release)
+                updated.append(result)
+            else:
+                constraints.release_identifiers(to_acquire)
+                retry.append(key)
+
+        for rpc in rollbacks:
+            try:
+                rpc.get_result()
+            except datastore_errors.Error:
+                DJANGAE_LOG.exception("Error rolling back update transaction")
+
+        caching.add_entities_to_cache(self.model, updated, caching.CachingSituation.DATASTORE_PUT)
+        return len(updated) + unchanged, retry
+
+    def _bulk_update(self, keys):
+        """
+            Updates the entities without any transactions, so if something else writes to one of
+            them between our Get and Put their change is lost. Returns the number of entities updated.
+        """
+        i = 0
+        while True:
+            batch = list(islice(keys, BULK_UPDATE_BATCH_SIZE))
+            if not batch:
+                break
+
+            results = [ x for x in datastore.Get(batch) if x is not None ]
+            if not results:
+                continue
+
+            i += len(results)
+
+            originals = []
+            changed_results = []
+            for result in results:
+                original, changed = self._apply_values(result)
+                if changed:
+                    originals.append(original)
+                    changed_results.append(result)
+
+            if not changed_results:
+                continue
+
+            datastore.Put(changed_results)
+
+            # Wipe both the old and new versions from the cache, so we don't have to read memcache first
+            caching.remove_entities_from_cache(self.model, originals + changed_results)
+
+        return i
+
+    def _queue_updates(self, batch, keys):
+        """
+            Updates the entities and queues them to be Put() at the end of batch_writes(). Any
+            entities which were already queued are updated in place, the rest are read in batches.
+            Unique markers are acquired straight away, and the old ones released after the Put().
+        """
+        i = 0
+        while True:
+            keys_batch = list(islice(keys, BULK_UPDATE_BATCH_SIZE))
+            if not keys_batch:
+                break
+
+            missing = [ x for x in keys_batch if x not in batch.entities ]
+            fetched = dict(zip(missing, datastore.Get(missing))) if missing else {}
+
+            for key in keys_batch:
+                if key in batch.entities:
+                    result = copy.deepcopy(batch.entities[key][1])
+                else:
+                    result = fetched[key]
+                    if result is None:
+                        continue
+
+                i += 1
+
+                original, changed = self._apply_values(result)
+                if not changed:
+                    continue
+
+                if constraints.constraint_checks_enabled(self.model):
+                    to_acquire, to_release = self._get_markers_for_update(original, result, changed)
+                    batch.update_markers(key, to_acquire, to_release)
+
+                if key not in batch.entities:
+                    batch.originals[key] = (self.model, original)
+
+                batch.queue(self.model, [result])
+
+        return i
+
     def execute(self):
         self.select.execute()
+        self.failures = []
+        self.unchanged = 0
+
+        keys = self._unchanged_keys_skipped(x.key() for x in self.select.results)
+
+        # The generator counts the skipped keys as they are consumed by _execute
+        try:
+            updated = self._execute(keys)
+        finally:
+            # Even if some of the updates failed the others were made
+            _invalidate_cached_queries(self.model)
+
+        return updated + self.unchanged
+
+    def _execute(self, keys):
+        batch = _active_write_batch()
+        if batch:
+            return self._queue_updates(batch, keys)
+
+        if datastore.IsInTransaction():
+            # Everything has to happen in the outer transaction, so there's nothing to run concurrently
+            i = 0
+            for key in keys:
+                if self._update_entity(key):
+                    # Only increment the count if we successfully updated
+                    i += 1
+
+            return i
 
-        results = self.select.results
+        if bulk_updates_enabled(self.model):
+            return self._bulk_update(keys)
 
         i = 0
-        for result in results:
-            if self._update_entity(result.key()):
-                # Only increment the count if we successfully updated
-                i += 1
+        while True:
+            batch = list(islice(keys, UPDATE_CONCURRENCY))
+            if not batch:
+                break
+
+            updated, retry = self._update_entities(batch)
+            i += updated
+
+            # Contended transactions are retried one at a time, as _update_entity retries them.
+            # They aren't inside atomic(), so nothing else would release the locks they take
+            for key in retry:
+                try:
+                    with caching.releasing_locks():
+                        if self._update_entity(key):
+                            i += 1
+                except (IntegrityError, datastore_errors.Error) as e:
+                    self.failures.append((key, e))
+
+        if self.failures:
+            for key, e in self.failures:
+                DJANGAE_LOG.error("Unable to update %s: %s", key, e)
+
+            if len(self.failures) == 1:
+                raise self.failures[0][1]
+
+            error_class = IntegrityError if all(isinstance(e, IntegrityError) for k, e in self.failures) else DatabaseError
+            raise error_class(
+                "Unable to update {} of {} entities, the rest were updated".format(len(self.failures), i + len(self.failures))
+            )
 
         return i
@@ -1,83 +1,192 @@
 import copy
-import collections
+import datetime
+import sys
+from collections import OrderedDict
+from itertools import chain
 
-from google.appengine.api import datastore
+from google.appengine.api import datastore, datastore_types, users
 
-class CopyDict(collections.MutableMapping):
+# Property values of these types are never modified in place, so snapshots can share them
+_IMMUTABLE_TYPES = (
+    type(None), bool, int, long, float, basestring,
+    datetime.datetime, datetime.date, datetime.time,
+    datastore_types.Key, users.User,
+)
+
+
+def _freeze(value):
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return value
+    elif isinstance(value, list):
+        return _FrozenList(_freeze(x) for x in value)
+    return _Mutable(value)
+
+
+def _thaw(value):
+    if isinstance(value, _FrozenList):
+        return [ _thaw(x) for x in value ]
+    elif isinstance(value, _Mutable):
+        return copy.deepcopy(value.value)
+    return value
+
+
+def _estimate_size(value):
+    if isinstance(value, _FrozenList):
+        return sys.getsizeof(value) + sum(_estimate_size(x) for x in value)
+    elif isinstance(value, _Mutable):
+        return sys.getsizeof(value.value)
+    return sys.getsizeof(value)
+
+
+class _FrozenList(tuple):
+    __slots__ = ()
+
+
+class _Mutable(object):
     """
-        It's important we don't pass references around in and out
-        of the cache, so this just ensures we copy stuff going in, and
-        copy it going out!
+        Wraps a property value which could be modified in place, so it's copied on the way out
     """
-    def __init__(self, *args, **kwargs):
-        self._store = {}
-        super(CopyDict, self).__init__(*args, **kwargs)
+    __slots__ = ("value",)
 
-    def __setitem__(self, key, value):
-        value = copy.deepcopy(value)
-        self._store[key] = value
+    def __init__(self, value):
+        self.value = copy.deepcopy(value)
 
-    def __getitem__(self, key):
-        value = self._store[key]
-        return copy.deepcopy(value)
 
-    def __delitem__(self, key):
-        del self._store[key]
+class EntitySnapshot(object):
+    """
+        An immutable copy of an entity's key and properties. A snapshot is made once when
+        an entity is cached, and shared by all of the identifiers it's cached under. A new
+        datastore.Entity is only built when entity() is called, so callers are free to
+        modify what they get back.
+    """
+    __slots__ = ("key", "properties", "unindexed_properties", "size")
+
+    def __init__(self, entity):
+        self.key = entity.key()
+        self.properties = tuple((k, _freeze(v)) for k, v in entity.iteritems())
+        self.size = sum(sys.getsizeof(k) + _estimate_size(v) for k, v in self.properties)
+        self.unindexed_properties = (
+            tuple(entity.unindexed_properties()) if isinstance(entity, datastore.Entity) else ()
+        )
+
+    def entity(self):
+        key = self.key
+        entity = datastore.Entity(
+            key.kind(), parent=key.parent(), _app=key.app(), namespace=key.namespace(),
+            id=key.id(), name=key.name(), unindexed_properties=self.unindexed_properties
+        )
 
-    def __iter__(self):
-        return iter(self._store)
+        # The values were validated when they were first set, so skip doing it again
+        dict.update(entity, ((k, _thaw(v)) for k, v in self.properties))
+        return entity
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
-    def __len__(self):
-        return len(self._store)
 
 class Context(object):
 
     def __init__(self, stack):
-        self.cache = CopyDict()
-        self.reverse_cache = CopyDict()
+        self.cache = {}
+        self.reverse_cache = OrderedDict() # Least recently used first
+        self.size = 0 # The estimated size of the cached entities in bytes
+        self.tombstones = set() # Identifiers which nothing exists with
+        self.locked = set() # Identifiers locked in memcache until the transaction is over
+        self.written_kinds = set() # Kinds whose cached query results are invalidated on commit
         self._stack = stack
 
     def apply(self, other):
+        # We replace everything, things that don't exist in the other have to go
+        self.cache.clear()
         self.cache.update(other.cache)
 
-        # We have to delete things that don't exist in the other
-        for k in self.cache.keys():
-            if k not in other.cache:
-                del self.cache[k]
-
+        self.reverse_cache.clear()
         self.reverse_cache.update(other.reverse_cache)
 
-        # We have to delete things that don't exist in the other
-        for k in self.reverse_cache.keys():
-            if k not in other.reverse_cache:
-                del self.reverse_cache[k]
+        self.size = other.size
+
+        self.tombstones.clear()
+        self.tombstones.update(other.tombstones)
 
     def cache_entity(self, identifiers, entity, situation):
         assert hasattr(identifiers, "__iter__")
 
+        snapshot = EntitySnapshot(entity)
+
+        # Remove any identifiers from an earlier version of the entity, a unique value may have changed
+        self.remove_entity(snapshot.key)
+
+        self.tombstones.difference_update(identifiers)
+
         for identifier in identifiers:
-            self.cache[identifier] = copy.deepcopy(entity)
+            # If another entity was cached with this unique value then it's out of date, so drop it
+            # entirely. That way each identifier only ever belongs to one cached entity
+            existing = self.cache.get(identifier)
+            if existing is not None:
+                self.remove_entity(existing.key)
+
+            self.cache[identifier] = snapshot
 
-        self.reverse_cache[entity.key()] = identifiers
+        self.reverse_cache[snapshot.key] = tuple(identifiers)
+        self.size += snapshot.size
+
+        self._evict()
 
     def remove_entity(self, entity_or_key):
         if not isinstance(entity_or_key, datastore.Key):
             entity_or_key = entity_or_key.key()
 
-        for identifier in self.reverse_cache[entity_or_key]:
-            del self.cache[identifier]
+        identifiers = self.reverse_cache.pop(entity_or_key, None)
+        if not identifiers:
+            return
 
-        del self.reverse_cache[entity_or_key]
+        self.size -= self.cache[identifiers[0]].size
+        for identifier in identifiers:
+            self.cache.pop(identifier, None)
 
     def get_entity(self, identifier):
-        return self.cache.get(identifier)
+        snapshot = self.cache.get(identifier)
+        if snapshot is None:
+            self._stack.misses += 1
+            return None
+
+        self._stack.hits += 1
+
+        # Move the entity to the most recently used end
+        self.reverse_cache[snapshot.key] = self.reverse_cache.pop(snapshot.key)
+        return snapshot.entity()
 
     def get_entity_by_key(self, key):
-        try:
-            identifier = self.reverse_cache[key][0]
-        except KeyError:
+        identifiers = self.reverse_cache.get(key)
+        if not identifiers:
+            self._stack.misses += 1
             return None
-        return self.get_entity(identifier)
+        return self.get_entity(identifiers[0])
+
+    def add_tombstones(self, identifiers):
+        max_entities = self._stack.max_entities
+        if max_entities is not None and len(self.tombstones) >= max_entities:
+            # Tombstones are cheap to recreate, so rather than tracking their use just start again
+            self.tombstones.clear()
+
+        self.tombstones.update(identifiers)
+
+    def has_tombstone(self, identifier):
+        return identifier in self.tombstones
+
+    def _evict(self):
+        max_entities = self._stack.max_entities
+        max_bytes = self._stack.max_bytes
+
+        while self.reverse_cache and (
+            (max_entities is not None and len(self.reverse_cache) > max_entities) or
+            (max_bytes is not None and self.size > max_bytes)
+        ):
+            self.remove_entity(next(iter(self.reverse_cache)))
+            self._stack.evictions += 1
 
 
 class ContextStack(object):
@@ -86,7 +195,14 @@ class ContextStack(object):
         caches for multi level transactions.
     """
 
-    def __init__(self):
+    def __init__(self, max_entities=None, max_bytes=None):
+        self.max_entities = max_entities
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
         self.stack = [ Context(self) ]
         self.staged = []
 
@@ -95,7 +211,7 @@ class ContextStack(object):
             Context(self) # Empty context
         )
 
-    def pop(self, apply_staged=False, clear_staged=False, discard=False):
+    def pop(self, apply_staged=False, clear_staged=False, discard=False, release_locks=True):
         """
             apply_staged: pop normally takes the top of the stack and adds it to a FIFO
             queue. By passing apply_staged it will pop to the FIFO queue then apply the
@@ -105,6 +221,9 @@ class ContextStack(object):
 
             discard: Ignores the popped entry in the stack, it's just discarded
 
+            release_locks: When discarding, release the memcache locks taken by the popped
+            entry. Pass False if the transaction it belongs to is still going on.
+
             The staged queue will be wiped out if the pop makes the size of the stack one,
             regardless of whether you pass clear_staged or not. This is for safety!
         """
@@ -114,7 +233,10 @@ class ContextStack(object):
         if not discard:
             self.staged.insert(0, self.stack.pop())
         else:
-            self.stack.pop()
+            # Nothing was written, so just release the locks
+            popped = self.stack.pop()
+            if release_locks:
+                caching.release_locks(popped.locked)
 
         if apply_staged:
             while self.staged:
@@ -122,6 +244,15 @@ class ContextStack(object):
                 for key in to_apply.reverse_cache.keys():
                     caching.remove_entity_from_cache_by_key(key, memcache_only=True)
 
+                # Wipe anything cached under the new identifiers, such as tombstones recorded
+                # by other requests before the transaction committed, and release the locks
+                caching.release_locks(
+                    chain(chain.from_iterable(to_apply.reverse_cache.values()), to_apply.locked)
+                )
+
+                for kind in to_apply.written_kinds:
+                    caching.invalidate_queries(kind)
+
                 self.top.apply(to_apply)
 
         if clear_staged or len(self.stack) == 1:
@@ -138,3 +269,13 @@ class ContextStack(object):
     @property
     def staged_count(self):
         return len(self.staged)
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entities": len(self.top.reverse_cache),
+            "bytes": self.top.size,
+        }
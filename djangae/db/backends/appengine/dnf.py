@@ -213,7 +213,7 @@ def parse_dnf(node, connection, ordering=None):
         assert excluded_pks is None
 
     if tree:
-        tree = tripled(tree)
+        tree = normalize(tree)
 
 
     if tree and tree[0] != 'OR':
@@ -350,3 +350,51 @@ def tripled(node):
             else:
                 children.append(_proc)
         return 'OR', children
+
+
+# Templates of normalized trees, keyed on the shape of the parsed tree. The literals in a
+# template are replaced with their position in the parsed tree, so that the (potentially very
+# expensive) DNF expansion only happens once per query shape and the values are bound per query
+MAX_TEMPLATE_CACHE_SIZE = 1000
+
+_template_cache = {}
+
+
+def _make_template(node, literals):
+    """
+        Returns the shape of the parsed tree, replacing each literal with its index
+        in the passed literals list (which is populated as a side effect)
+    """
+    if node[0] == 'LIT':
+        literals.append(node)
+        return ('LIT', len(literals) - 1)
+
+    return (node[0], tuple(_make_template(x, literals) for x in node[1]))
+
+
+def _bind_template(node, literals):
+    if node[0] == 'LIT':
+        return literals[node[1]]
+
+    return (node[0], [_bind_template(x, literals) for x in node[1]])
+
+
+def normalize(node):
+    """
+        Applies DNF to a parsed tree. This is the same as calling tripled() but the
+        structure of the result is cached against the shape of the tree.
+    """
+    literals = []
+    shape = _make_template(node, literals)
+
+    template = _template_cache.get(shape)
+    if template is None:
+        if len(_template_cache) >= MAX_TEMPLATE_CACHE_SIZE:
+            _template_cache.clear()
+
+        # tripled() only ever inspects the connectors, so the index literals are carried
+        # through the expansion untouched
+        template = tripled(_bind_template(shape, [('LIT', i) for i in xrange(len(literals))]))
+        _template_cache[shape] = template
+
+    return _bind_template(template, literals)
@@ -0,0 +1,32 @@
+from djangae.db.backends.appengine import commands
+from djangae.db.transaction import ContextDecorator
+
+
+class BatchWritesDecorator(ContextDecorator):
+    """
+        Decorator and context manager which queues the Puts made by inserts and updates, and then
+        makes them all on exit with as few datastore.Put calls as possible. Unique markers are still
+        acquired straight away, so IntegrityErrors are raised by the save() which caused them.
+
+        Queued entities can be read back by primary key, but won't be returned by other queries
+        until they have been Put(). Deletes, flushes and transactions make the queued Puts first.
+        Nesting batch_writes() does nothing, the Puts are made when the outermost one exits. If an
+        exception is raised inside it, the queued Puts are discarded and their markers released.
+
+        Updates don't get a transaction per entity when they are queued, so if somebody else
+        updates the same entity before the batch is Put their changes are overwritten.
+    """
+
+    def __enter__(self):
+        self.started = commands.start_write_batch()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.started:
+            return
+
+        if exc_type:
+            commands.discard_write_batch()
+        else:
+            commands.finish_write_batch()
+
+batch_writes = BatchWritesDecorator
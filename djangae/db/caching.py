@@ -1,6 +1,6 @@
 from google.appengine.api import datastore
 
-from djangae.db.backends.appengine import caching, context
+from djangae.db.backends.appengine import caching
 
 
 class DisableCache(object):
@@ -58,4 +58,15 @@ def clear_context_cache():
     if datastore.IsInTransaction():
         raise RuntimeError("Clearing the context cache inside a transaction breaks everything, we can't let you do that")
 
-    caching._context.stack = context.ContextStack()
+    caching.ensure_context()
+    caching._context.stack = caching.new_context_stack()
+    caching._context.snapshots.clear()
+
+
+def context_cache_stats():
+    """
+        Returns the hits, misses and evictions of the context cache since the start of
+        the request, along with the number of entities and estimated bytes it holds.
+    """
+    caching.ensure_context()
+    return caching._context.stack.stats
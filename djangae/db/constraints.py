@@ -1,5 +1,6 @@
 import datetime
 import logging
+from itertools import chain
 
 from django.core.exceptions import NON_FIELD_ERRORS
 
@@ -53,7 +54,13 @@ class UniqueMarker(db.Model):
         return "_djangae_unique_marker"
 
 
-def acquire_identifiers(identifiers, entity_key):
+def acquire_identifiers(identifiers, entity_key, unsaved=False):
+    """
+        Acquires the markers for the identifiers, pointing them at entity_key. Pass unsaved=True if
+        the entity hasn't been Put() yet, the markers then don't point at anything until
+        update_instance_on_markers is called, otherwise they could be taken by anyone who
+        noticed the entity didn't exist.
+    """
     @db.transactional(propagation=TransactionOptions.INDEPENDENT, xg=True)
     def acquire_marker(identifier):
         identifier_key = Key.from_path(UniqueMarker.kind(), identifier)
@@ -72,7 +79,7 @@ def acquire_identifiers(identifiers, entity_key):
 
         marker = UniqueMarker(
             key=identifier_key,
-            instance=entity_key if entity_key.id_or_name() else None,  # May be None if unsaved
+            instance=entity_key if entity_key.id_or_name() and not unsaved else None,  # May be None if unsaved
             created=datetime.datetime.utcnow()
         )
         marker.put()
@@ -120,11 +127,11 @@ def update_instance_on_markers(entity, markers):
         update(marker, instance)
 
 
-def acquire_bulk(model, entities):
+def acquire_bulk(model, entities, unsaved=False):
     markers = []
     try:
         for entity in entities:
-            markers.append(acquire(model, entity))
+            markers.append(acquire(model, entity, unsaved=unsaved))
 
     except:
         for m in markers:
@@ -133,14 +140,14 @@ def acquire_bulk(model, entities):
     return markers
 
 
-def acquire(model, entity):
+def acquire(model, entity, unsaved=False):
     """
         Given a model and entity, this tries to acquire unique marker locks for the instance. If the locks already exist
         then an IntegrityError will be thrown.
     """
 
     identifiers = unique_identifiers_from_entity(model, entity, ignore_pk=True)
-    return acquire_identifiers(identifiers, entity.key())
+    return acquire_identifiers(identifiers, entity.key(), unsaved=unsaved)
 
 
 def release_markers(markers):
@@ -167,6 +174,18 @@ def release(model, entity):
     release_identifiers(identifiers)
 
 
+def release_bulk(model, entities):
+    """
+        Releases the markers of all the entities with a single Delete
+    """
+    identifiers = list(chain.from_iterable(
+        unique_identifiers_from_entity(model, x, ignore_pk=True) for x in entities
+    ))
+
+    if identifiers:
+        release_identifiers(identifiers)
+
+
 class UniquenessMixin(object):
     """ Mixin overriding the methods checking value uniqueness.
 
@@ -11,7 +11,7 @@ from google.appengine.api.datastore import (
 )
 from google.appengine.datastore.datastore_rpc import TransactionOptions
 
-from djangae.db.backends.appengine import caching
+from djangae.db.backends.appengine import caching, commands
 
 
 def in_atomic_block():
@@ -102,6 +102,11 @@ class AtomicDecorator(ContextDecorator):
             propagation=TransactionOptions.INDEPENDENT if self.independent else None
         )
 
+        # The transaction wouldn't see any Puts queued by batch_writes(), or those of asynchronous
+        # writes which haven't finished, so make sure they're done first
+        commands.flush_write_batch()
+        commands.wait_all()
+
         conn = _GetConnection()
 
         self.transaction_started = True
@@ -163,8 +168,9 @@ class NonAtomicDecorator(ContextDecorator):
         self._original_connection = _PopConnection()
         self._original_context = copy.deepcopy(caching._context)
 
+        # The outer transaction is still going on, so its locks are released when it finishes
         while len(caching._context.stack.stack) > 1:
-            caching._context.stack.pop(discard=True)
+            caching._context.stack.pop(discard=True, release_locks=False)
 
 
     def _do_exit(self, exception):
@@ -1,7 +1,8 @@
 #STANDARD LIB
+import calendar
 from datetime import datetime
 from decimal import Decimal
-from itertools import chain
+from itertools import groupby
 
 import warnings
 
@@ -12,13 +13,12 @@ from django.db import models
 from django.db.backends.util import format_number
 from django.db import IntegrityError
 from django.utils import timezone
-from google.appengine.api import datastore
+from google.appengine.api import datastore, datastore_types, users
 from google.appengine.api.datastore import Key, Query
 
 #DJANGAE
 from djangae.utils import memoized
 from djangae.indexing import special_indexes_for_column, REQUIRES_SPECIAL_INDEXES
-from djangae.db.backends.appengine.dbapi import CouldBeSupportedError
 
 
 def make_timezone_naive(value):
@@ -281,92 +281,254 @@ def django_ordering_comparison(ordering, lhs, rhs):
     return 0
 
 
-def entity_matches_query(entity, query):
+def _datastore_sort_value(value):
     """
-        Return True if the entity would potentially be returned by the datastore
-        query
+        Returns a value which sorts in the same place that the datastore would
+        put the passed property value, including between values of different types
+    """
+    # Order matters here, bool is a subclass of int and ByteString a subclass of str
+    if value is None:
+        return (0, None)
+    elif isinstance(value, bool):
+        return (2, value)
+    elif isinstance(value, (int, long)):
+        return (1, value)
+    elif isinstance(value, datetime):
+        # The datastore stores datetimes as microseconds, so they sort with the integers
+        return (1, calendar.timegm(value.utctimetuple()) * 1000000 + value.microsecond)
+    elif isinstance(value, datastore_types.ByteString):
+        return (3, value)
+    elif isinstance(value, basestring):
+        return (4, value)
+    elif isinstance(value, float):
+        return (5, value)
+    elif isinstance(value, datastore_types.GeoPt):
+        return (6, value)
+    elif isinstance(value, users.User):
+        return (7, value)
+    elif isinstance(value, Key):
+        return (8, value)
+    return (9, value)
+
+
+def _compile_sort_value(order, direction):
+    if order == "__key__":
+        return lambda entity: (8, entity.key())
+
+    # A list property is sorted by its lowest value when ascending, and its highest when descending
+    pick = max if direction == Query.DESCENDING else min
+
+    def sort_value(entity):
+        value = entity.get(order)
+        if isinstance(value, list):
+            return pick([ _datastore_sort_value(x) for x in value ]) if value else (0, None)
+        return _datastore_sort_value(value)
+
+    return sort_value
+
+
+class _Descending(object):
     """
+        Reverses the comparison of the wrapped sort value, so that descending
+        orderings can be part of a single sort key
+    """
+    __slots__ = ("value",)
 
-    def lt(x, y):
-        if x is None and y is not None:
-            return True
-        elif x is not None and y is None:
-            return False
-        else:
-            return x < y
+    def __init__(self, value):
+        self.value = value
 
-    def gt(x, y):
-        if x is None and y is not None:
-            return False
-        elif x is not None and y is None:
-            return True
-        else:
-            return x > y
+    def __lt__(self, other):
+        return other.value < self.value
 
-    gte = lambda x, y: not lt(x, y)
-    lte = lambda x, y: not gt(x, y)
+    def __gt__(self, other):
+        return other.value > self.value
 
-    OPERATORS = {
-        "=": lambda x, y: x == y,
-        "<": lt,
-        ">": gt,
-        "<=": lte,
-        ">=": gte
-    }
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
 
-    queries = [query]
-    if isinstance(query, datastore.MultiQuery):
-        raise CouldBeSupportedError("We just need to separate the multiquery "
-                                    "into 'queries' then everything should work")
 
-    for query in queries:
-        comparisons = chain(
-            [("_Query__kind", "=", "_Query__kind") ],
-            [tuple(x.split(" ") + [ x ]) for x in query.keys()]
+@memoized
+def _compile_sort_key(ordering):
+    values = [ _compile_sort_value(order, direction) for order, direction in ordering ]
+    descending = [ direction == Query.DESCENDING for order, direction in ordering ]
+
+    if not any(descending):
+        return lambda entity: tuple(x(entity) for x in values)
+
+    def sort_key(entity):
+        return tuple(
+            _Descending(value(entity)) if desc else value(entity)
+            for value, desc in zip(values, descending)
         )
+    return sort_key
 
-        for ent_attr, op, query_attr in comparisons:
-            if ent_attr == "__key__":
-                continue
 
-            op = OPERATORS[op]  # We want this to throw if there's some op we don't know about
+def compile_sort_key(ordering):
+    """
+        Returns a function which returns a sort key for an entity, which orders entities
+        in the same way the datastore would for the (property, direction) ordering. Useful for
+        merging sorted streams, for sorting a list of entities use sort_entities instead.
+    """
+    return _compile_sort_key(tuple(ordering))
 
-            if ent_attr == "_Query__kind":
-                ent_attr = entity.kind()
-            else:
-                ent_attr = entity.get(ent_attr)
 
-            if callable(ent_attr):
-                # entity.kind() is a callable, so we need this to save special casing it in a more
-                # ugly way
-                ent_attr = ent_attr()
+@memoized
+def _compile_sort_passes(ordering):
+    # Group the consecutive orderings with the same direction, each group is one pass of a stable sort
+    def tuple_key(values):
+        return lambda entity: tuple(x(entity) for x in values)
 
-            if not isinstance(query_attr, (list, tuple)):
-                query_attrs = [query_attr]
-            else:
-                # The query value can be a list of ANDed values
-                query_attrs = query_attr
-
-            query_attrs = [ getattr(query, x) if x == "_Query__kind" else query.get(x) for x in query_attrs ]
-
-            if not isinstance(ent_attr, (list, tuple)):
-                ent_attr = [ ent_attr ]
-
-            matches = False
-            for query_attr in query_attrs:  # [22, 23]
-                #If any of the values don't match then this query doesn't match
-                if not any([op(attr, query_attr) for attr in ent_attr]):
-                    matches = False
-                    break
-            else:
-                # One of the ent_attrs matches the query_attrs
-                matches = True
-
-            if not matches:
-                # One of the AND values didn't match
-                break
+    passes = []
+    for descending, group in groupby(ordering, lambda x: x[1] == Query.DESCENDING):
+        values = [ _compile_sort_value(order, direction) for order, direction in group ]
+        passes.append((tuple_key(values), descending))
+
+    # The least significant ordering must be sorted first
+    return list(reversed(passes))
+
+
+def sort_entities(entities, ordering):
+    """
+        Returns a list of the entities sorted in the way the datastore would sort them
+        for the (property, direction) ordering. This uses a stable sort for each run of
+        properties with the same direction, so that all comparisons are of plain tuples.
+    """
+    entities = list(entities)
+    for sort_key, descending in _compile_sort_passes(tuple(ordering)):
+        entities.sort(key=sort_key, reverse=descending)
+    return entities
+
+
+def _lt(x, y):
+    if x is None and y is not None:
+        return True
+    elif x is not None and y is None:
+        return False
+    else:
+        return x < y
+
+
+def _gt(x, y):
+    if x is None and y is not None:
+        return False
+    elif x is not None and y is None:
+        return True
+    else:
+        return x > y
+
+
+MATCHER_OPERATORS = {
+    "=": lambda x, y: x == y,
+    "<": _lt,
+    ">": _gt,
+    "<=": lambda x, y: not _gt(x, y),
+    ">=": lambda x, y: not _lt(x, y),
+}
+
+
+class QueryMatcher(object):
+    """
+        A predicate which returns True if the entity would potentially be returned by the
+        datastore query (or any of the queries of a MultiQuery). The query filters are parsed once
+        when the matcher is created, so a matcher can be cheaply applied to many entities.
+    """
+
+    def __init__(self, query):
+        if isinstance(query, datastore.MultiQuery):
+            queries = query._MultiQuery__bound_queries
         else:
-            # If we got through the loop without breaking, then the entity matches
-            return True
+            queries = [query]
+
+        self.branches = []
+        for query in queries:
+            comparisons = []
+            for filter_string, value in query.items():
+                prop, op = filter_string.split(" ")
+                if prop == "__key__":
+                    continue
+
+                # We want this to throw if there's some op we don't know about
+                op = MATCHER_OPERATORS[op]
+
+                # The query value can be a list of ANDed values
+                values = tuple(value) if isinstance(value, (list, tuple)) else (value,)
+                comparisons.append((prop, op, values))
+
+            self.branches.append((query._Query__kind, comparisons))
+
+    def _branch_matches(self, entity, kind, comparisons):
+        if entity.kind() != kind:
+            return False
+
+        for prop, op, values in comparisons:
+            attrs = entity.get(prop)
+            if not isinstance(attrs, (list, tuple)):
+                attrs = (attrs,)
+
+            # If an entity has a list property then any of its values can match each of the query values
+            for value in values:
+                if not any(op(attr, value) for attr in attrs):
+                    return False
+
+        return True
+
+    def __call__(self, entity):
+        return any(self._branch_matches(entity, kind, comparisons) for kind, comparisons in self.branches)
+
+    def filter(self, entities):
+        return [ x for x in entities if self(x) ]
 
-    return False
+
+_query_matcher_cache = {}
+MAX_QUERY_MATCHER_CACHE_SIZE = 1000
+
+
+def _query_matcher_cache_key(query):
+    if isinstance(query, datastore.MultiQuery):
+        queries = query._MultiQuery__bound_queries
+    else:
+        queries = [query]
+
+    # Filters on the key are ignored by the matcher, so queries which only differ by key (e.g.
+    # those for a pk__in) share a matcher
+    return tuple(
+        (
+            x._Query__kind,
+            tuple(sorted(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in x.iteritems() if not k.startswith("__key__ ")
+            ))
+        ) for x in queries
+    )
+
+
+def compile_query_matcher(query):
+    """
+        Returns a QueryMatcher for the query, reusing one from an earlier query
+        with the same filters where possible
+    """
+    try:
+        cache_key = _query_matcher_cache_key(query)
+        matcher = _query_matcher_cache.get(cache_key)
+    except TypeError:
+        # Unhashable filter value, so just don't cache it
+        return QueryMatcher(query)
+
+    if matcher is None:
+        if len(_query_matcher_cache) >= MAX_QUERY_MATCHER_CACHE_SIZE:
+            _query_matcher_cache.clear()
+
+        matcher = _query_matcher_cache[cache_key] = QueryMatcher(query)
+
+    return matcher
+
+
+def entity_matches_query(entity, query):
+    """
+        Return True if the entity would potentially be returned by the datastore
+        query
+    """
+    return compile_query_matcher(query)(entity)
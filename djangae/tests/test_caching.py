@@ -8,6 +8,7 @@ from django.db import models
 from django.http import HttpRequest
 from django.core.signals import request_finished, request_started
 from django.core.cache import cache
+from django.test.utils import override_settings
 
 from djangae.contrib import sleuth
 from djangae.test import TestCase
@@ -41,7 +42,7 @@ class ContextStackTests(TestCase):
 
         stack.top.cache_entity(["bananas:1"], entity, caching.CachingSituation.DATASTORE_PUT)
 
-        self.assertEqual({"bananas": 1}, stack.top.cache.values()[0])
+        self.assertEqual({"bananas": 1}, stack.top.get_entity("bananas:1"))
 
         stack.push()
 
@@ -67,7 +68,7 @@ class ContextStackTests(TestCase):
         stack.pop(apply_staged=True, clear_staged=True)
 
         self.assertEqual(1, stack.size)
-        self.assertEqual({"bananas": 3}, stack.top.cache["bananas:1"])
+        self.assertEqual({"bananas": 3}, stack.top.get_entity("bananas:1"))
         self.assertEqual(0, stack.staged_count)
 
     def test_property_deletion(self):
@@ -86,7 +87,67 @@ class ContextStackTests(TestCase):
 
         stack.pop(apply_staged=True, clear_staged=True)
 
-        self.assertEqual({"field1": "oneone"}, stack.top.cache["entity"])
+        self.assertEqual({"field1": "oneone"}, stack.top.get_entity("entity"))
+
+    def test_snapshots_are_shared_between_identifiers(self):
+        stack = ContextStack()
+
+        entity = FakeEntity({"field1": "one", "list_field": ["a", "b"]})
+
+        stack.top.cache_entity(["entity:1", "entity:2"], entity, caching.CachingSituation.DATASTORE_PUT)
+
+        # Both identifiers point at the same snapshot, rather than a copy each
+        self.assertIs(stack.top.cache["entity:1"], stack.top.cache["entity:2"])
+
+        # Changing the original entity, or an entity we read back, doesn't affect the cache
+        entity["list_field"].append("c")
+        stack.top.get_entity("entity:1")["list_field"].append("d")
+
+        self.assertEqual({"field1": "one", "list_field": ["a", "b"]}, stack.top.get_entity("entity:2"))
+        self.assertIsNot(stack.top.get_entity("entity:1"), stack.top.get_entity("entity:1"))
+
+    def test_least_recently_used_entities_are_evicted(self):
+        stack = ContextStack(max_entities=2)
+
+        entity1 = FakeEntity({"field1": "one"})
+        entity2 = FakeEntity({"field1": "two"})
+        entity3 = FakeEntity({"field1": "three"})
+
+        stack.top.cache_entity(["entity:1", "field1:one"], entity1, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.cache_entity(["entity:2", "field1:two"], entity2, caching.CachingSituation.DATASTORE_PUT)
+
+        # Reading entity1 makes entity2 the least recently used
+        self.assertTrue(stack.top.get_entity("entity:1"))
+
+        stack.top.cache_entity(["entity:3", "field1:three"], entity3, caching.CachingSituation.DATASTORE_PUT)
+
+        self.assertIsNone(stack.top.get_entity_by_key(entity2.key()))
+        self.assertItemsEqual(["entity:1", "field1:one", "entity:3", "field1:three"], stack.top.cache.keys())
+        self.assertItemsEqual([entity1.key(), entity3.key()], stack.top.reverse_cache.keys())
+
+        self.assertEqual(1, stack.hits)
+        self.assertEqual(1, stack.misses)
+        self.assertEqual(1, stack.evictions)
+        self.assertEqual(2, stack.stats["entities"])
+
+    def test_entities_are_evicted_past_the_byte_limit(self):
+        entity1 = FakeEntity({"field1": "x" * 1000})
+        entity2 = FakeEntity({"field1": "y" * 1000})
+
+        stack = ContextStack(max_bytes=1500)
+
+        stack.top.cache_entity(["entity:1"], entity1, caching.CachingSituation.DATASTORE_PUT)
+        size = stack.top.size
+        self.assertTrue(size > 1000)
+
+        stack.top.cache_entity(["entity:2"], entity2, caching.CachingSituation.DATASTORE_PUT)
+
+        self.assertItemsEqual(["entity:2"], stack.top.cache.keys())
+        self.assertEqual(size, stack.top.size)
+        self.assertEqual(1, stack.evictions)
+
+        stack.top.remove_entity(entity2.key())
+        self.assertEqual(0, stack.top.size)
 
 
 
@@ -330,6 +391,82 @@ class MemcacheCachingTests(TestCase):
 
         self.assertTrue(datastore_query.called)
 
+    @disable_cache(memcache=False, context=True)
+    def test_sliced_query_starts_from_stored_cursor(self):
+        for i in xrange(5):
+            CachingTestModel.objects.create(field1="Apple {}".format(i), comb1=i, comb2="Cherry")
+
+        queryset = CachingTestModel.objects.order_by("comb1")
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.QUERY_CURSORS_ENABLED", True), \
+                sleuth.switch("djangae.db.backends.appengine.caching.QUERY_CURSORS_MIN_OFFSET", 1):
+
+            self.assertEqual([1, 2], [x.comb1 for x in queryset[1:3]])
+
+            # The cursor at the end of the last slice is reused, so no offset is needed
+            with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+                self.assertEqual([3, 4], [x.comb1 for x in queryset[3:5]])
+
+            self.assertEqual(0, datastore_query.calls[0][1]["offset"])
+            self.assertTrue(datastore_query.calls[0][1]["start_cursor"])
+
+            # Further offsets are relative to the nearest cursor
+            with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+                self.assertEqual([4], [x.comb1 for x in queryset[4:5]])
+
+            self.assertEqual(1, datastore_query.calls[0][1]["offset"])
+
+        # Without the setting, offsets are passed straight through
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual([4], [x.comb1 for x in queryset[4:5]])
+
+        self.assertEqual(4, datastore_query.calls[0][1]["offset"])
+        self.assertFalse("start_cursor" in datastore_query.calls[0][1])
+
+    @disable_cache(memcache=False, context=True)
+    def test_stored_cursor_is_for_the_end_of_a_slice_spanning_batches(self):
+        for i in xrange(10):
+            CachingTestModel.objects.create(field1="Apple {}".format(i), comb1=i, comb2="Cherry")
+
+        queryset = CachingTestModel.objects.order_by("comb1")
+        run = datastore.Query.Run
+
+        def run_in_small_batches(query, **kwargs):
+            return run(query, batch_size=2, **kwargs)
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.QUERY_CURSORS_ENABLED", True), \
+                sleuth.switch("djangae.db.backends.appengine.caching.QUERY_CURSORS_MIN_OFFSET", 1), \
+                sleuth.switch("google.appengine.api.datastore.Query.Run", run_in_small_batches):
+
+            self.assertEqual([1, 2, 3, 4, 5], [x.comb1 for x in queryset[1:6]])
+            self.assertEqual([6, 7], [x.comb1 for x in queryset[6:8]])
+
+    @disable_cache(memcache=False, context=True)
+    @override_settings(DJANGAE_CACHE_QUERIES=True)
+    def test_query_results_are_cached_until_the_next_write(self):
+        for i in xrange(3):
+            CachingTestModel.objects.create(field1="Apple {}".format(i), comb1=i, comb2="Cherry")
+
+        queryset = CachingTestModel.objects.order_by("comb1")
+
+        self.assertEqual([0, 1], [x.comb1 for x in queryset[:2]])
+
+        # The keys are read from memcache, and the entities from the key cache
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                self.assertEqual([0, 1], [x.comb1 for x in queryset[:2]])
+
+        self.assertFalse(datastore_query.called)
+        self.assertFalse(datastore_get.called)
+
+        # Any write to the model invalidates the stored results
+        CachingTestModel.objects.create(field1="Banana", comb1=-1, comb2="Cherry")
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual([-1, 0], [x.comb1 for x in queryset[:2]])
+
+        self.assertTrue(datastore_query.called)
+
     @disable_cache(memcache=False, context=True)
     def test_get_by_key_hits_memcache(self):
         entity_data = {
@@ -346,6 +483,210 @@ class MemcacheCachingTests(TestCase):
 
         self.assertFalse(datastore_get.called)
 
+    @disable_cache(memcache=False, context=True)
+    def test_bulk_create_caches_with_one_set_many(self):
+        objs = [ CachingTestModel(field1="Field {}".format(i), comb1=i, comb2="Cherry") for i in xrange(10) ]
+
+        with sleuth.watch("django.core.cache.cache.set_many") as cache_set_many:
+            CachingTestModel.objects.bulk_create(objs)
+
+        # Each entity is cached under its pk, field1 and the comb1/comb2 combination
+        self.assertEqual(1, cache_set_many.call_count)
+        self.assertEqual(30, len(cache_set_many.calls[0][0][0]))
+
+    @disable_cache(memcache=False, context=True)
+    def test_pk_in_hits_memcache(self):
+        apple = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        banana = CachingTestModel.objects.create(field1="Banana", comb1=2, comb2="Cherry")
+        cherry = CachingTestModel.objects.create(field1="Cherry", comb1=3, comb2="Cherry")
+
+        queryset = CachingTestModel.objects.filter(pk__in=[apple.pk, banana.pk, cherry.pk]).order_by("field1")
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual([apple, banana, cherry], list(queryset))
+
+        self.assertFalse(datastore_get.called)
+
+        # Only the evicted entities are fetched, and they are all written back at once
+        caching.remove_entity_from_cache_by_key(datastore.Key.from_path(CachingTestModel._meta.db_table, apple.pk))
+        caching.remove_entity_from_cache_by_key(datastore.Key.from_path(CachingTestModel._meta.db_table, cherry.pk))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            with sleuth.watch("google.appengine.api.memcache.Client.cas_multi") as cache_cas_multi:
+                self.assertEqual([apple, banana, cherry], list(queryset))
+
+        self.assertEqual(1, datastore_get.call_count)
+        self.assertItemsEqual([apple.pk, cherry.pk], [x.id_or_name() for x in datastore_get.calls[0][0][0]])
+        self.assertEqual(1, cache_cas_multi.call_count)
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual([apple, banana, cherry], list(queryset))
+
+        self.assertFalse(datastore_get.called)
+
+    @disable_cache(memcache=False, context=True)
+    def test_stale_read_isnt_cached_after_invalidation(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        original = CachingTestModel.objects.create(id=222, **entity_data)
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, original.pk)
+
+        cache.clear()
+
+        # A reader misses memcache, which takes a lease, and reads the entity
+        self.assertEqual({}, caching.get_from_cache_by_keys([key]))
+        entity = datastore.Get(key)
+
+        # Meanwhile a writer invalidates the entity, so the lease is lost and what was read isn't cached
+        caching.remove_entity_from_cache_by_key(key)
+        caching.add_entity_to_cache(CachingTestModel, entity, caching.CachingSituation.DATASTORE_GET)
+
+        for identifier in identifiers:
+            self.assertIsNone(cache.get(identifier))
+
+        # Without the invalidation it is
+        self.assertEqual({}, caching.get_from_cache_by_keys([key]))
+        caching.add_entity_to_cache(CachingTestModel, entity, caching.CachingSituation.DATASTORE_GET)
+
+        for identifier in identifiers:
+            self.assertEqual(entity_data, cache.get(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_read_before_a_delete_finishes_isnt_cached(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        original = CachingTestModel.objects.create(id=222, **entity_data)
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, original.pk)
+
+        delete_async = datastore.DeleteAsync
+
+        def read_then_delete(keys, **kwargs):
+            # A reader misses memcache after it was invalidated, and reads the entity before it's deleted
+            self.assertEqual({}, caching.get_from_cache_by_keys([key]))
+            entity = datastore.Get(key)
+            caching.add_entity_to_cache(CachingTestModel, entity, caching.CachingSituation.DATASTORE_GET)
+
+            return delete_async(keys, **kwargs)
+
+        with sleuth.switch("google.appengine.api.datastore.DeleteAsync", read_then_delete) as delete:
+            CachingTestModel.objects.filter(pk=222).delete()
+
+        self.assertTrue(delete.called)
+        for identifier in identifiers:
+            self.assertIsNone(cache.get(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_update_of_deleted_entity_wipes_all_its_identifiers(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        original = CachingTestModel.objects.create(id=222, **entity_data)
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+
+        # Deleted behind the cache's back, so the update finds it in memcache but not in the datastore
+        datastore.Delete(datastore.Key.from_path(CachingTestModel._meta.db_table, original.pk))
+
+        self.assertEqual(0, CachingTestModel.objects.filter(pk=222).update(comb2="Damson"))
+
+        for identifier in identifiers:
+            self.assertIsNone(cache.get(identifier))
+
+        self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Apple")
+
+    @disable_cache(memcache=False, context=True)
+    def test_retried_updates_release_their_locks(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        CachingTestModel.objects.create(id=222, **entity_data)
+
+        # Every update is contended, so they're all retried one at a time
+        with sleuth.switch(
+                "djangae.db.backends.appengine.commands.UpdateCommand._update_entities",
+                lambda command, keys: (0, list(keys))):
+            self.assertEqual(1, CachingTestModel.objects.filter(pk=222).update(comb2="Damson"))
+
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+        entity_data["comb2"] = "Damson"
+        identifiers += unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+
+        for identifier in identifiers:
+            self.assertNotEqual(caching.LOCK, cache.get(identifier))
+
+        self.assertFalse(caching._context.stack.top.locked)
+
+    @disable_cache(memcache=False, context=True)
+    def test_locks_are_held_until_the_transaction_finishes(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        original = CachingTestModel.objects.create(id=222, **entity_data)
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+
+        with transaction.atomic():
+            original.save()
+
+            # Leaving the transaction for a while doesn't release its locks
+            with transaction.non_atomic():
+                for identifier in identifiers:
+                    self.assertEqual(caching.LOCK, cache.get(identifier))
+
+            for identifier in identifiers:
+                self.assertEqual(caching.LOCK, cache.get(identifier))
+
+        for identifier in identifiers:
+            self.assertIsNone(cache.get(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_independent_transaction_releases_its_locks(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        original = CachingTestModel.objects.create(id=222, **entity_data)
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+
+        with transaction.atomic():
+            with transaction.atomic(independent=True):
+                original.save()
+
+            # The outer transaction is still going on, but the inner one's locks are released
+            for identifier in identifiers:
+                self.assertIsNone(cache.get(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_update_wipes_memcache_with_one_delete_many(self):
+        for i in xrange(3):
+            CachingTestModel.objects.create(field1="Apple {}".format(i), comb1=i, comb2="Cherry")
+
+        with sleuth.watch("django.core.cache.cache.delete_many") as cache_delete_many:
+            with sleuth.watch("django.core.cache.cache.get") as cache_get:
+                self.assertEqual(3, CachingTestModel.objects.update(comb2="Damson"))
+
+        self.assertEqual(1, cache_delete_many.call_count)
+        self.assertFalse(cache_get.called)
+
     @disable_cache(memcache=False, context=True)
     def test_get_by_key_hits_datastore_inside_transaction(self):
         entity_data = {
@@ -379,6 +720,35 @@ class MemcacheCachingTests(TestCase):
 
         self.assertFalse(datastore_get.called)
 
+    @disable_cache(memcache=False, context=True)
+    def test_missing_entities_are_cached_in_memcache(self):
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            for i in xrange(2):
+                self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, pk=1)
+                self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Apple")
+
+        # The second time round the tombstones in memcache answer both lookups
+        self.assertEqual(2, datastore_get.call_count)
+
+        # Creating the entity replaces the tombstones
+        original = CachingTestModel.objects.create(pk=1, field1="Apple", comb1=1, comb2="Cherry")
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual(original, CachingTestModel.objects.get(pk=1))
+            self.assertEqual(original, CachingTestModel.objects.get(field1="Apple"))
+
+        self.assertFalse(datastore_get.called)
+
+    @disable_cache(memcache=False, context=True)
+    def test_missing_entities_arent_cached_inside_transaction(self):
+        with transaction.atomic():
+            self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, pk=1)
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, pk=1)
+
+        self.assertTrue(datastore_get.called)
+
     @disable_cache(memcache=False, context=True)
     def test_unique_get_hits_datastore_inside_transaction(self):
         entity_data = {
@@ -626,6 +996,36 @@ class ContextCachingTests(TestCase):
 
         self.assertTrue(datastore_get.called)
 
+    @disable_cache(memcache=True, context=False)
+    def test_keys_then_get_query_hits_cache(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        original = CachingTestModel.objects.create(**entity_data)
+        other = CachingTestModel.objects.create(field1="Banana", comb1=1, comb2="Damson")
+
+        with sleuth.switch("djangae.db.backends.appengine.commands.keys_then_get_enabled", lambda model: True):
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+                    instances = list(CachingTestModel.objects.filter(comb1=1).order_by("field1"))
+
+            self.assertEqual([original, other], instances)
+            self.assertTrue(datastore_query.calls[0][0][0].IsKeysOnly())
+            self.assertFalse(datastore_get.called)
+
+            # Only the entities missing from the cache are fetched
+            caching.remove_entity_from_cache_by_key(datastore.Key.from_path(CachingTestModel._meta.db_table, other.pk))
+
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                instances = list(CachingTestModel.objects.filter(comb1=1).order_by("field1"))
+
+            self.assertEqual([original, other], instances)
+            self.assertEqual(1, datastore_get.call_count)
+            self.assertEqual([other.pk], [x.id_or_name() for x in datastore_get.calls[0][0][0]])
+
     @disable_cache(memcache=True, context=False)
     def test_unique_filter_hits_cache(self):
         entity_data = {
@@ -686,6 +1086,23 @@ class ContextCachingTests(TestCase):
 
         self.assertFalse(datastore_get.called)
 
+    @disable_cache(memcache=True, context=False)
+    def test_missing_entities_are_cached(self):
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            for i in xrange(2):
+                self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, pk=1)
+                self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Apple")
+
+        self.assertEqual(2, datastore_get.call_count)
+
+        original = CachingTestModel.objects.create(pk=1, field1="Apple", comb1=1, comb2="Cherry")
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual(original, CachingTestModel.objects.get(pk=1))
+            self.assertEqual(original, CachingTestModel.objects.get(field1="Apple"))
+
+        self.assertFalse(datastore_get.called)
+
     @disable_cache(memcache=True, context=False)
     def test_context_cache_cleared_after_request(self):
         """ The context cache should be cleared between requests. """
@@ -1,4 +1,5 @@
 import os
+import copy
 
 from cStringIO import StringIO
 import datetime
@@ -19,7 +20,7 @@ from django.test import RequestFactory
 from django.utils.safestring import SafeText
 from django.forms.models import modelformset_factory
 from django.db.models.sql.datastructures import EmptyResultSet
-from google.appengine.api.datastore_errors import EntityNotFoundError, BadValueError
+from google.appengine.api.datastore_errors import EntityNotFoundError, BadValueError, Timeout
 from google.appengine.api import datastore
 from google.appengine.ext import deferred
 from google.appengine.api import taskqueue
@@ -35,8 +36,11 @@ from django.db import IntegrityError, NotSupportedError
 from djangae.db.constraints import UniqueMarker, UniquenessMixin
 from djangae.db.unique_utils import _unique_combinations, unique_identifiers_from_entity
 from djangae.indexing import add_special_index
-from djangae.db.utils import entity_matches_query, decimal_to_string, normalise_field_value
-from djangae.db.caching import disable_cache
+from djangae.db.utils import entity_matches_query, decimal_to_string, normalise_field_value, sort_entities, compile_sort_key, compile_query_matcher
+from djangae.db.caching import disable_cache, clear_context_cache
+from djangae.db.asynchronous import save_async, bulk_create_async, delete_async
+from djangae.db.batching import batch_writes
+from djangae.db import transaction
 from djangae.fields import ComputedCharField, SetField, ListField, GenericRelationField, RelatedSetField
 from djangae.models import CounterShard
 from djangae.db.backends.appengine.dnf import parse_dnf
@@ -170,6 +174,20 @@ class Related(models.Model):
         app_label = "djangae"
 
 
+class NumberedModel(models.Model):
+    number = models.IntegerField(unique=True)
+
+    class Meta:
+        app_label = "djangae"
+
+
+class RelatedByNumber(models.Model):
+    relation = models.ForeignKey(NumberedModel, to_field="number")
+
+    class Meta:
+        app_label = "djangae"
+
+
 class NullDate(models.Model):
     date = models.DateField(null=True, default=None)
     datetime = models.DateTimeField(null=True, default=None)
@@ -245,6 +263,29 @@ class PaginatorModel(models.Model):
         app_label = "djangae"
 
 
+class SaveOverrideModel(models.Model):
+    name = models.CharField(max_length=32)
+
+    class Meta:
+        app_label = "djangae"
+
+    def save(self, *args, **kwargs):
+        self.name = self.name.upper()
+        super(SaveOverrideModel, self).save(*args, **kwargs)
+
+
+class BulkUpdateModel(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+    counter = models.IntegerField(default=0)
+
+    class Djangae:
+        disable_constraint_checks = True
+        bulk_updates = True
+
+    class Meta:
+        app_label = "djangae"
+
+
 class BackendTests(TestCase):
     def test_entity_matches_query(self):
         entity = datastore.Entity("test_model")
@@ -275,6 +316,107 @@ class BackendTests(TestCase):
         entity["name"] = [ "Bob", "Fred", "Dave" ]
         self.assertTrue(entity_matches_query(entity, query))  # ListField test
 
+    def test_entity_matches_multi_query(self):
+        entity = datastore.Entity("test_model")
+        entity["name"] = "Charlie"
+        entity["age"] = 22
+
+        charlie = datastore.Query("test_model")
+        charlie["name ="] = "Charlie"
+
+        over_30 = datastore.Query("test_model")
+        over_30["age >"] = 30
+
+        self.assertTrue(entity_matches_query(entity, datastore.MultiQuery([over_30, charlie], [])))
+        self.assertFalse(entity_matches_query(entity, datastore.MultiQuery([over_30], [])))
+
+    def test_query_matchers_are_shared_between_keys(self):
+        first = datastore.Query("test_model")
+        first["name ="] = "Charlie"
+        first["__key__ ="] = datastore.Key.from_path("test_model", 1)
+
+        second = datastore.Query("test_model")
+        second["name ="] = "Charlie"
+        second["__key__ ="] = datastore.Key.from_path("test_model", 2)
+
+        self.assertIs(compile_query_matcher(first), compile_query_matcher(second))
+
+        second["name ="] = "Fred"
+        self.assertIsNot(compile_query_matcher(first), compile_query_matcher(second))
+
+    def test_sort_entities(self):
+        def make_entity(id, **kwargs):
+            entity = datastore.Entity("test_model", id=id)
+            entity.update(kwargs)
+            return entity
+
+        a = make_entity(1, name="Charlie", age=22)
+        b = make_entity(2, name="Bob", age=None)
+        c = make_entity(3, name=u"Alice", age=22)
+        d = make_entity(4, name=["Dave", "Aaron"], age=5.0)
+
+        ASC, DESC = datastore.Query.ASCENDING, datastore.Query.DESCENDING
+
+        # None sorts first, and floats sort after integers
+        self.assertEqual([b, a, c, d], sort_entities([a, b, c, d], [("age", ASC), ("__key__", ASC)]))
+
+        # Mixed directions, and lists sort by their lowest value ascending and their highest descending
+        self.assertEqual([b, c, a, d], sort_entities([a, b, c, d], [("age", ASC), ("name", ASC)]))
+        self.assertEqual([d, c, a, b], sort_entities([a, b, c, d], [("age", DESC), ("name", ASC)]))
+        self.assertEqual([d, c, b, a], sort_entities([a, b, c, d], [("name", ASC)]))
+        self.assertEqual([d, a, b, c], sort_entities([a, b, c, d], [("name", DESC)]))
+
+        # The sort key gives the same order
+        for ordering in ([("age", DESC), ("name", ASC)], [("name", DESC)], [("age", DESC), ("__key__", DESC)]):
+            self.assertEqual(
+                sort_entities([a, b, c, d], ordering),
+                sorted([a, b, c, d], key=compile_sort_key(ordering))
+            )
+
+    def test_value_converters_match_convert_values(self):
+        ops = connections['default'].ops
+
+        checks = [
+            (models.IntegerField(), 1L, 1),
+            (models.FloatField(), 1, 1.0),
+            (models.CharField(), "Apple", u"Apple"),
+            (models.DateField(), datetime.datetime(2015, 1, 1), datetime.date(2015, 1, 1)),
+            (models.DecimalField(max_digits=4, decimal_places=2), "12.50", decimal.Decimal("12.50")),
+            (ListField(models.CharField()), None, []),
+            (SetField(models.CharField()), ["Apple"], set(["Apple"])),
+            (models.IntegerField(null=True), None, None),
+        ]
+
+        for field, value, expected in checks:
+            converted = ops.get_value_converter(field)(value)
+            self.assertEqual(expected, converted)
+            self.assertEqual(type(expected), type(converted))
+            self.assertEqual(ops.convert_values(value, field), converted)
+
+    def test_distinct_values_are_bounded(self):
+        from djangae.db.backends.appengine.commands import DistinctValues
+
+        # When ordered by the value, only the last value needs to be kept
+        ordered = DistinctValues(ordered=True)
+        self.assertEqual([True, False, True, False, True], [ordered.add(x) for x in (1, 1, 2, 2, 3)])
+
+        unordered = DistinctValues(ordered=False, max_size=2)
+        self.assertEqual([True, True, False, True, False], [unordered.add(x) for x in (1, 2, 1, 3, 3)])
+        self.assertEqual(2, len(unordered.values))
+
+    def test_inserts_are_only_logged_when_debugging(self):
+        TestFruit.objects.create(name="Apple", color="Red")
+        queries = connections['default'].connection.queries
+        logged = len(queries)
+
+        TestFruit.objects.create(name="Banana", color="Yellow")
+        self.assertEqual(logged, len(queries))
+
+        with override_settings(DEBUG=True):
+            TestFruit.objects.create(name="Cherry", color="Red")
+
+        self.assertEqual(logged + 1, len(queries))
+
     def test_defaults(self):
         fruit = TestFruit.objects.create(name="Apple", color="Red")
         self.assertEqual("Unknown", fruit.origin)
@@ -327,6 +469,262 @@ class BackendTests(TestCase):
                 instance, created = UniqueModel.objects.get_or_create(unique_field="Test")
                 self.assertFalse(created)
 
+    def test_bulk_create_with_explicit_pks(self):
+        fruits = [ TestFruit(name="Fruit {}".format(i), color="Red") for i in xrange(30) ]
+
+        # The entities are Put() in concurrent transactions, rather than one at a time
+        with sleuth.watch("google.appengine.api.datastore.Put") as datastore_put:
+            TestFruit.objects.bulk_create(fruits)
+
+        self.assertFalse(datastore_put.called)
+        self.assertEqual(30, TestFruit.objects.count())
+
+        # If any of the keys already exist, nothing is inserted
+        fruits = [ TestFruit(name="Fruit {}".format(i), color="Green") for i in xrange(25, 35) ]
+        with self.assertRaises(IntegrityError):
+            TestFruit.objects.bulk_create(fruits)
+
+        self.assertEqual(30, TestFruit.objects.count())
+        self.assertFalse(TestFruit.objects.filter(name="Fruit 34").exists())
+
+        fruits = [ TestFruit(name="Apple", color="Red"), TestFruit(name="Apple", color="Green") ]
+        with self.assertRaises(IntegrityError):
+            TestFruit.objects.bulk_create(fruits)
+
+        self.assertFalse(TestFruit.objects.filter(name="Apple").exists())
+
+    def test_update_runs_transactions_concurrently(self):
+        TestFruit.objects.bulk_create([ TestFruit(name="Fruit {}".format(i), color="Red") for i in xrange(30) ])
+
+        with sleuth.watch("google.appengine.api.datastore.Put") as datastore_put:
+            self.assertEqual(30, TestFruit.objects.update(color="Green"))
+
+        self.assertFalse(datastore_put.called)
+        self.assertEqual(30, TestFruit.objects.filter(color="Green").count())
+
+        # A unique constraint failure only stops the entity which caused it from being updated
+        ModelWithUniques.objects.create(name="One")
+        ModelWithUniques.objects.create(name="Two")
+
+        with self.assertRaises(IntegrityError):
+            ModelWithUniques.objects.update(name="Three")
+
+        self.assertEqual(1, ModelWithUniques.objects.filter(name="Three").count())
+        self.assertEqual(2, ModelWithUniques.objects.count())
+
+    def test_bulk_updates_skip_transactions(self):
+        for i in xrange(10):
+            BulkUpdateModel.objects.create(name="Counter {}".format(i))
+
+        # Cache one of them, so we can check it gets invalidated
+        instance = BulkUpdateModel.objects.get(name="Counter 0")
+
+        # All of the entities are written with a single Put
+        with sleuth.watch("google.appengine.api.datastore.Put") as datastore_put:
+            self.assertEqual(10, BulkUpdateModel.objects.update(counter=5))
+
+        self.assertEqual(1, datastore_put.call_count)
+        self.assertEqual(10, BulkUpdateModel.objects.filter(counter=5).count())
+        self.assertEqual(5, BulkUpdateModel.objects.get(pk=instance.pk).counter)
+        self.assertEqual(5, BulkUpdateModel.objects.get(name="Counter 0").counter)
+
+    def test_delete_only_reads_entities_with_unique_fields(self):
+        for i in xrange(3):
+            PaginatorModel.objects.create(foo=i)
+
+        with sleuth.watch("djangae.db.backends.appengine.commands.DeleteCommand._delete_entities") as delete_entities:
+            PaginatorModel.objects.all().delete()
+
+        self.assertFalse(delete_entities.called)
+        self.assertEqual(0, PaginatorModel.objects.count())
+
+        for name in ("One", "Two", "Three"):
+            ModelWithUniques.objects.create(name=name)
+
+        # The markers of all the entities are released at once
+        with sleuth.watch("djangae.db.constraints.release_identifiers") as release_identifiers:
+            ModelWithUniques.objects.all().delete()
+
+        self.assertEqual(1, release_identifiers.call_count)
+        self.assertEqual(0, ModelWithUniques.objects.count())
+
+        # Which means we can reuse the values
+        ModelWithUniques.objects.create(name="One")
+
+    def test_async_writes(self):
+        instances = [ PaginatorModel(foo=i) for i in xrange(5) ]
+
+        # All the Puts are sent before we wait for any of them
+        with sleuth.watch("google.appengine.api.datastore.PutAsync") as put_async:
+            futures = [ save_async(x) for x in instances ]
+            self.assertEqual(5, put_async.call_count)
+
+        for future in futures:
+            self.assertIsNone(future.get_result())
+
+        self.assertTrue(all(x.pk for x in instances))
+        self.assertEqual(5, PaginatorModel.objects.count())
+
+        objs = [ PaginatorModel(foo=i) for i in xrange(5, 10) ]
+        self.assertEqual(objs, bulk_create_async(PaginatorModel, objs).get_result())
+        self.assertEqual(10, PaginatorModel.objects.count())
+
+        self.assertIsNone(delete_async(PaginatorModel.objects.filter(foo__lt=5)).get_result())
+        self.assertEqual(5, PaginatorModel.objects.count())
+
+        # Unique constraints are checked when the save is made, not when the result is fetched
+        save_async(ModelWithUniques(name="One")).get_result()
+        with self.assertRaises(IntegrityError):
+            save_async(ModelWithUniques(name="One"))
+
+    def test_async_saves_dont_skip_save_overrides(self):
+        future = save_async(SaveOverrideModel(name="one"))
+
+        self.assertTrue(future.done())
+        self.assertEqual("ONE", SaveOverrideModel.objects.get().name)
+
+    def test_transactions_wait_for_async_writes(self):
+        future = save_async(PaginatorModel(foo=1))
+        self.assertFalse(future.done())
+
+        with transaction.atomic():
+            self.assertTrue(future.done())
+
+    def test_batch_writes(self):
+        with sleuth.watch("google.appengine.api.datastore.Put") as datastore_put:
+            with batch_writes():
+                instances = [ PaginatorModel.objects.create(foo=i) for i in xrange(5) ]
+                self.assertTrue(all(x.pk for x in instances))
+                self.assertFalse(datastore_put.called)
+
+                # Queued entities can be read back, and saved again, by primary key
+                instance = PaginatorModel.objects.get(pk=instances[0].pk)
+                instance.foo = 10
+                instance.save()
+
+        self.assertEqual(1, datastore_put.call_count)
+        self.assertEqual(5, PaginatorModel.objects.count())
+        self.assertEqual(10, PaginatorModel.objects.get(pk=instances[0].pk).foo)
+
+        # Unique constraints are still checked by the save
+        ModelWithUniques.objects.create(name="One")
+        with batch_writes():
+            with self.assertRaises(IntegrityError):
+                ModelWithUniques.objects.create(name="One")
+
+            ModelWithUniques.objects.create(name="Two")
+
+        self.assertEqual(2, ModelWithUniques.objects.count())
+
+    def test_batch_writes_release_markers_of_entities_which_arent_put(self):
+        with self.assertRaises(ValueError):
+            with batch_writes():
+                ModelWithUniques.objects.create(name="One")
+
+                # The marker doesn't point at the instance until it exists, so it can't be stolen
+                self.assertIsNone(UniqueMarker.all().get().instance)
+                raise ValueError()
+
+        # Nothing is Put if the batch raises, and the markers are released
+        self.assertEqual(0, ModelWithUniques.objects.count())
+        self.assertEqual(0, UniqueMarker.all().count())
+
+        def failing_put(*args, **kwargs):
+            raise Timeout()
+
+        with sleuth.switch("djangae.db.backends.appengine.commands.datastore.Put", failing_put):
+            with self.assertRaises(Timeout):
+                with batch_writes():
+                    ModelWithUniques.objects.create(name="One")
+
+        self.assertEqual(0, ModelWithUniques.objects.count())
+        self.assertEqual(0, UniqueMarker.all().count())
+
+        # Once the instance has been Put its marker points at it
+        with batch_writes():
+            instance = ModelWithUniques.objects.create(name="One")
+
+        self.assertEqual(instance.pk, UniqueMarker.all().get().instance.id())
+
+    @disable_cache(memcache=True, context=False)
+    def test_foreign_key_gets_are_batched(self):
+        relations = [ Relation.objects.create() for i in xrange(3) ]
+        for relation in relations:
+            Related.objects.create(headline="Headline", relation=relation)
+
+        clear_context_cache()
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.AUTO_BATCH_GETS", True):
+            related = list(Related.objects.all())
+
+            # The first relation is fetched along with the others, which are then in the cache
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                self.assertItemsEqual(relations, [ x.relation for x in related ])
+
+        self.assertEqual(1, datastore_get.call_count)
+        self.assertEqual(3, len(datastore_get.calls[0][0][0]))
+
+    def test_foreign_keys_with_a_to_field_arent_batched(self):
+        # 0 isn't a valid id, so it would raise if it was used to build a key
+        RelatedByNumber.objects.create(relation=NumberedModel.objects.create(number=0))
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.AUTO_BATCH_GETS", True):
+            with sleuth.watch("djangae.db.backends.appengine.caching.add_pending_gets") as add_pending_gets:
+                related = list(RelatedByNumber.objects.all())
+
+        self.assertEqual([], add_pending_gets.calls[0][0][0])
+        self.assertEqual(0, related[0].relation.number)
+
+    def test_insert_with_pk_clears_tombstones_without_constraint_checks(self):
+        self.assertRaises(BulkUpdateModel.DoesNotExist, BulkUpdateModel.objects.get, pk=5)
+
+        instance, created = BulkUpdateModel.objects.get_or_create(pk=5, defaults={"name": "Five"})
+        self.assertTrue(created)
+
+        self.assertEqual(instance, BulkUpdateModel.objects.get(pk=5))
+
+        clear_context_cache()
+        self.assertEqual(instance, BulkUpdateModel.objects.get(pk=5))
+
+    def test_saves_without_changes_are_skipped(self):
+        ModelWithUniques.objects.create(name="One")
+        instance = ModelWithUniques.objects.get(name="One")
+
+        with sleuth.watch("djangae.db.backends.appengine.commands.UpdateCommand._update_entities") as update_entities:
+            with sleuth.watch("djangae.db.constraints.get_markers_for_update") as get_markers:
+                instance.save()
+
+        self.assertFalse(update_entities.called)
+        self.assertFalse(get_markers.called)
+
+        instance.name = "Two"
+        with sleuth.watch("djangae.db.backends.appengine.commands.UpdateCommand._update_entities") as update_entities:
+            instance.save()
+
+        self.assertTrue(update_entities.called)
+        self.assertEqual("Two", ModelWithUniques.objects.get().name)
+
+    def test_saves_are_never_skipped_inside_transactions(self):
+        instance = ModelWithUniques.objects.create(name="One")
+
+        with transaction.atomic():
+            with sleuth.watch("djangae.db.backends.appengine.commands.UpdateCommand._update_entities") as update_entities:
+                instance.save()
+
+        self.assertTrue(update_entities.called)
+
+    def test_query_results_arent_trusted_for_skipping_saves(self):
+        ModelWithUniques.objects.create(name="One")
+        clear_context_cache()
+
+        # A query result might be stale, so it isn't remembered as the current state
+        instance = ModelWithUniques.objects.filter(name__startswith="O").get()
+
+        with sleuth.watch("djangae.db.backends.appengine.commands.UpdateCommand._update_entities") as update_entities:
+            instance.save()
+
+        self.assertTrue(update_entities.called)
+
     def test_setting_non_null_null_throws_integrity_error(self):
         with self.assertRaises(IntegrityError):
             IntegerModel.objects.create(integer_field=None)
@@ -464,6 +862,36 @@ class BackendTests(TestCase):
         self.assertEqual([cherry, banana], list(TestFruit.objects.exclude(pk=pear.pk).order_by("-name")[:2]))
         self.assertEqual([banana, apple], list(TestFruit.objects.exclude(pk=pear.pk).order_by("origin", "name")[:2]))
 
+    def test_query_plans_are_shared_between_queries_of_the_same_shape(self):
+        from djangae.db.backends.appengine import commands
+
+        commands._query_plan_cache.clear()
+
+        TestUser.objects.create(username="A", email="a@example.com")
+        TestUser.objects.create(username="B", email="b@example.com")
+
+        with sleuth.watch("djangae.db.backends.appengine.commands._convert_ordering") as convert_ordering:
+            self.assertEqual("a@example.com", TestUser.objects.filter(username="A").order_by("email")[0].email)
+            self.assertEqual("b@example.com", TestUser.objects.filter(username="B").order_by("email")[0].email)
+
+        self.assertEqual(1, convert_ordering.call_count)
+
+        # A different shape gets its own plan
+        with sleuth.watch("djangae.db.backends.appengine.commands._convert_ordering") as convert_ordering:
+            self.assertEqual(["A"], list(TestUser.objects.filter(username="A").values_list("username", flat=True)))
+
+        self.assertEqual(1, convert_ordering.call_count)
+
+        # So does the same shape of query on another database
+        other = copy.copy(connections["default"])
+        other.alias = "other"
+
+        query = TestUser.objects.filter(username="A").order_by("email").query
+        self.assertIsNot(
+            commands.get_query_plan(connections["default"], query),
+            commands.get_query_plan(other, query)
+        )
+
     def test_datetime_fields(self):
         date = datetime.datetime.today()
         dt = datetime.datetime.now()
@@ -677,6 +1105,25 @@ class QueryNormalizationTests(TestCase):
         ])
         self.assertEqual(expected, parse_dnf(qs.query.where, connection=connection)[0])
 
+    def test_normalization_is_cached_by_shape(self):
+        from djangae.db.backends.appengine import dnf
+
+        connection = connections['default']
+        dnf._template_cache.clear()
+
+        qs = TestUser.objects.filter(Q(username="A") | Q(username="B"), email="a@example.com")
+        parse_dnf(qs.query.where, connection=connection)
+
+        # Same shape, different values, so the normalized template should be reused
+        qs = TestUser.objects.filter(Q(username="C") | Q(username="D"), email="c@example.com")
+        with sleuth.watch("djangae.db.backends.appengine.dnf.tripled") as tripled:
+            cached = parse_dnf(qs.query.where, connection=connection)[0]
+
+        self.assertFalse(tripled.called)
+
+        dnf._template_cache.clear()
+        self.assertEqual(parse_dnf(qs.query.where, connection=connection)[0], cached)
+
 
 
 
@@ -731,6 +1178,26 @@ class ConstraintTests(TestCase):
         with self.assertRaises(IntegrityError):
             UniqueModel.objects.create(unique_field="One")
 
+    def test_flush_deletes_all_tables_at_once(self):
+        for i in xrange(3):
+            ModelWithUniques.objects.create(name="Name {}".format(i))
+            UniqueModel.objects.create(unique_field="Name {}".format(i))
+
+        tables = [ ModelWithUniques._meta.db_table, UniqueModel._meta.db_table ]
+        commands = connections['default'].ops.sql_flush(None, tables, [])
+        self.assertEqual(1, len(commands))
+
+        with sleuth.watch("google.appengine.api.datastore.DeleteAsync") as delete_async:
+            commands[0].execute()
+
+        self.assertTrue(delete_async.called)
+        self.assertEqual(0, ModelWithUniques.objects.count())
+        self.assertEqual(0, UniqueModel.objects.count())
+
+        # The markers went too
+        ModelWithUniques.objects.create(name="Name 0")
+        UniqueModel.objects.create(unique_field="Name 0")
+
     def test_recently_deleted_unique_doesnt_come_back(self):
         instance = ModelWithUniques.objects.create(name="One")
 
@@ -1319,6 +1786,36 @@ class EdgeCaseTests(TestCase):
         query = TestUser.objects.filter(pk__in=list(xrange(1, 32)))
         list(query)
 
+    def test_multi_query_merges_concurrent_subqueries(self):
+        query = TestUser.objects.filter(username__in=["A", "E", "C"]).order_by("-username")
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+            self.assertEqual([self.u5, self.u3, self.u1], list(query))
+
+        # One RPC per subquery, but all started before the results are merged
+        self.assertEqual(3, query_run.call_count)
+
+        # Entities returned by more than one subquery are only returned once
+        query = TestUser.objects.filter(Q(username="A") | Q(email="test@example.com")).order_by("-username")
+        self.assertEqual([self.u2, self.u1], list(query))
+        self.assertEqual([self.u1], list(query[1:]))
+        self.assertEqual(2, query.count())
+
+    def test_pk_in_query_fetches_keys_in_chunks(self):
+        pks = [self.u1.pk, self.u2.pk, self.u3.pk, self.u4.pk, self.u5.pk]
+
+        with sleuth.switch("djangae.db.backends.appengine.commands.QUERY_BY_KEYS_CHUNK_SIZE", 2):
+            with disable_cache():
+                with sleuth.watch("google.appengine.api.datastore.GetAsync") as get_async:
+                    results = list(TestUser.objects.filter(pk__in=pks).order_by("-username"))
+
+                self.assertEqual([self.u5, self.u4, self.u3, self.u2, self.u1], results)
+                self.assertEqual(3, get_async.call_count)
+
+                results = TestUser.objects.filter(pk__in=pks)
+                self.assertItemsEqual([self.u1, self.u2, self.u3, self.u4, self.u5], results)
+                self.assertEqual([self.u2, self.u3], list(results.order_by("username")[1:3]))
+
     def test_self_relations(self):
         obj = SelfRelatedModel.objects.create()
         obj2 = SelfRelatedModel.objects.create(related=obj)